@@ -0,0 +1,445 @@
+"""
+Microbenchmarks of the bot's hot paths at several history sizes.
+
+usage:
+python benchmarks/hot_paths.py --save benchmarks/baseline.json
+python benchmarks/hot_paths.py --compare benchmarks/baseline.json [--threshold 1.25]
+python benchmarks/hot_paths.py --filter truncate
+
+--compare exits with status 1 if any benchmark is slower than
+threshold times its baseline median.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Iterator, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from nio import MatrixRoom, RoomMessageText  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from bot import Bot  # noqa: E402
+from conversation_cache import Conversation  # noqa: E402
+import imagegen  # noqa: E402
+from log import getlogger  # noqa: E402
+from send_message import send_room_message  # noqa: E402
+
+HISTORY_SIZES = [10, 100, 1000]
+IMAGE_SIZES = [256, 512, 1024]
+
+USER_ID = "@bot:localhost"
+SENDER_ID = "@alice:localhost"
+ROOM_ID = "!room:localhost"
+
+REPLY_MESSAGE = """Here is an example:
+
+| name | value |
+| ---- | ----- |
+| a    | 1     |
+| b    | 2     |
+
+```python
+def hello():
+    print("hello world")
+```
+
+1. first
+2. second
+line one
+line two
+"""
+
+
+class FakeClient:
+    """
+    Stand in for nio.AsyncClient, requests return immediately
+    """
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def room_send(self, room_id, message_type, content, **kwargs):
+        self.sent += 1
+
+    async def room_typing(self, room_id, typing_state=True, **kwargs):
+        pass
+
+
+class Case:
+    def __init__(
+        self,
+        name: str,
+        fn: Callable,
+        setup: Optional[Callable] = None,
+    ) -> None:
+        self.name = name
+        self.fn = fn
+        self.setup = setup
+
+
+class Context:
+    """
+    Shared state of the benchmarks, a Bot with its Chatbot in a temp directory
+    """
+
+    def __init__(self, tmpdir: str) -> None:
+        self.tmpdir = Path(tmpdir)
+        # context.db is created in the working directory
+        os.chdir(self.tmpdir)
+        self.bot = Bot(
+            homeserver="http://localhost:8008",
+            user_id=USER_ID,
+            device_id="BENCHMARK",
+            access_token="benchmark",
+            openai_api_key="benchmark",
+        )
+        self.chatbot = self.bot.chatbot
+        self.snapshots: dict[str, tuple[list, list]] = {}
+
+    def conversation(self, size: int) -> str:
+        """
+        Build a conversation of size messages, return its id
+        """
+        convo_id = f"history-{size}"
+        if convo_id in self.snapshots:
+            return convo_id
+        self.chatbot.reset(convo_id=convo_id)
+        for i in range(size):
+            role = "user" if i % 2 == 0 else "assistant"
+            self.chatbot.add_to_conversation(
+                f"message {i}: " + "the quick brown fox jumps over the lazy dog " * 4,
+                role,
+                convo_id=convo_id,
+            )
+        self.chatbot._save_conversation(convo_id)
+        self.chatbot.writer.flush()
+        conversation = self.chatbot.conversation[convo_id]
+        self.snapshots[convo_id] = (
+            list(conversation.messages),
+            list(conversation.tokens),
+        )
+        return convo_id
+
+    def restore(self, convo_id: str) -> None:
+        messages, tokens = self.snapshots[convo_id]
+        self.chatbot.conversation[convo_id] = Conversation(list(messages), list(tokens))
+
+    def close(self) -> None:
+        self.chatbot.close()
+
+
+def bench_get_token_count(ctx: Context) -> Iterator[Case]:
+    for size in HISTORY_SIZES:
+        convo_id = ctx.conversation(size)
+        yield Case(
+            f"get_token_count[{size}]",
+            lambda convo_id=convo_id: ctx.chatbot.get_token_count(convo_id),
+        )
+
+
+def bench_truncate(ctx: Context) -> Iterator[Case]:
+    for size in HISTORY_SIZES:
+        convo_id = ctx.conversation(size)
+
+        def setup(convo_id=convo_id):
+            ctx.restore(convo_id)
+            # drop roughly half of the conversation
+            ctx.chatbot.truncate_limit = ctx.chatbot.get_token_count(convo_id) // 2
+
+        yield Case(
+            f"truncate_conversation[{size}]",
+            lambda convo_id=convo_id: ctx.chatbot._Chatbot__truncate_conversation(
+                convo_id
+            ),
+            setup,
+        )
+
+
+def bench_save_load(ctx: Context) -> Iterator[Case]:
+    for size in HISTORY_SIZES:
+        convo_id = ctx.conversation(size)
+
+        def save(convo_id=convo_id):
+            ctx.chatbot._save_conversation(convo_id)
+            ctx.chatbot.writer.flush()
+
+        yield Case(
+            f"save_conversation[{size}]",
+            save,
+            lambda convo_id=convo_id: ctx.restore(convo_id),
+        )
+        yield Case(
+            f"load_conversation[{size}]",
+            lambda convo_id=convo_id: ctx.chatbot._load_conversation(convo_id),
+        )
+
+
+def bench_send_room_message(ctx: Context) -> Iterator[Case]:
+    client = FakeClient()
+    yield Case(
+        "send_room_message[plain]",
+        lambda: send_room_message(client, ROOM_ID, REPLY_MESSAGE),
+    )
+    yield Case(
+        "send_room_message[reply]",
+        lambda: send_room_message(
+            client,
+            ROOM_ID,
+            REPLY_MESSAGE,
+            sender_id=SENDER_ID,
+            user_message="!gpt show me an example",
+            reply_to_event_id="$event",
+        ),
+    )
+    long_message = REPLY_MESSAGE * 20
+    yield Case(
+        "send_room_message[long]",
+        lambda: send_room_message(client, ROOM_ID, long_message),
+    )
+
+
+def bench_decode_images_b64(ctx: Context) -> Iterator[Case]:
+    for size in IMAGE_SIZES:
+        img = Image.effect_noise((size, size), 64).convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        b64_data = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        # png to jpeg is re-encoded, png to png is passed through
+        for image_format in ("jpeg", "png"):
+            yield Case(
+                f"decode_images_b64[{size},{image_format}]",
+                lambda b64_data=b64_data, image_format=image_format: (
+                    imagegen.decode_images_b64([b64_data], image_format=image_format)
+                ),
+            )
+
+
+def make_event(event_id: str, content: dict) -> RoomMessageText:
+    return RoomMessageText.from_dict(
+        {
+            "type": "m.room.message",
+            "event_id": event_id,
+            "sender": SENDER_ID,
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": ROOM_ID,
+            "content": content,
+        }
+    )
+
+
+def bench_message_callback(ctx: Context) -> Iterator[Case]:
+    bot = ctx.bot
+    room = MatrixRoom(ROOM_ID, USER_ID)
+
+    async def schedule(
+        room_id, reply_to_event_id, sender_id, user_message, coro, lane=None
+    ):
+        # measure the dispatch only, not the upstream request
+        coro.close()
+
+    bot.schedule = schedule
+
+    async def pic(*args, **kwargs):
+        # !pic is started as a task, not through schedule
+        pass
+
+    bot.pic = pic
+
+    thread_root_id = "$thread-root"
+    ctx.chatbot.reset(convo_id=thread_root_id)
+
+    events = {
+        "plain": make_event(
+            "$plain", {"msgtype": "m.text", "body": "good morning everyone"}
+        ),
+        "gpt": make_event(
+            "$gpt", {"msgtype": "m.text", "body": "!gpt what is the capital of France"}
+        ),
+        "chat": make_event(
+            "$chat", {"msgtype": "m.text", "body": "!chat tell me a joke"}
+        ),
+        "pic": make_event("$pic", {"msgtype": "m.text", "body": "!pic a red apple"}),
+        "mention": make_event(
+            "$mention",
+            {
+                "msgtype": "m.text",
+                "body": f"{USER_ID} hello there",
+                "m.mentions": {"user_ids": [USER_ID]},
+            },
+        ),
+        "thread": make_event(
+            "$thread",
+            {
+                "msgtype": "m.text",
+                "body": "and what about Germany",
+                "m.relates_to": {
+                    "rel_type": "m.thread",
+                    "event_id": thread_root_id,
+                    "is_falling_back": True,
+                },
+            },
+        ),
+        "unknown_thread": make_event(
+            "$unknown-thread",
+            {
+                "msgtype": "m.text",
+                "body": "a thread the bot is not part of",
+                "m.relates_to": {
+                    "rel_type": "m.thread",
+                    "event_id": "$other-root",
+                    "is_falling_back": True,
+                },
+            },
+        ),
+    }
+    for name, event in events.items():
+        yield Case(
+            f"message_callback[{name}]",
+            lambda event=event: bot.message_callback(room, event),
+        )
+
+
+BENCHMARKS = [
+    bench_get_token_count,
+    bench_truncate,
+    bench_save_load,
+    bench_send_room_message,
+    bench_decode_images_b64,
+    bench_message_callback,
+]
+
+
+async def measure(case: Case, min_time: float, min_rounds: int) -> list[float]:
+    """
+    Time case.fn until min_time seconds and min_rounds rounds are spent,
+    setup is not timed
+    """
+    timings = []
+    total = 0.0
+    while total < min_time or len(timings) < min_rounds:
+        if case.setup is not None:
+            case.setup()
+        start = time.perf_counter()
+        result = case.fn()
+        if asyncio.iscoroutine(result):
+            await result
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed)
+        total += elapsed
+        if len(timings) >= 100000:
+            break
+    return timings
+
+
+async def run(args) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cwd = os.getcwd()
+        ctx = Context(tmpdir)
+        try:
+            for benchmark in BENCHMARKS:
+                for case in benchmark(ctx):
+                    if args.filter and args.filter not in case.name:
+                        continue
+                    # warm up
+                    await measure(case, 0, 1)
+                    timings = await measure(case, args.min_time, args.min_rounds)
+                    results[case.name] = {
+                        "rounds": len(timings),
+                        "min_us": round(min(timings) * 1e6, 2),
+                        "median_us": round(statistics.median(timings) * 1e6, 2),
+                        "mean_us": round(statistics.mean(timings) * 1e6, 2),
+                    }
+                    print(
+                        f"{case.name:<40} median {results[case.name]['median_us']:>12.2f} us"  # noqa: E501
+                        f"  min {results[case.name]['min_us']:>12.2f} us"
+                        f"  rounds {len(timings)}"
+                    )
+        finally:
+            ctx.close()
+            os.chdir(cwd)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Print the ratio to the baseline, return names of the regressed benchmarks
+    """
+    regressions = []
+    print(f"\n{'benchmark':<40} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<40} {'-':>12} {result['median_us']:>12.2f} {'new':>8}")
+            continue
+        base = baseline[name]["median_us"]
+        ratio = result["median_us"] / base if base else 1.0
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:<40} {base:>12.2f} {result['median_us']:>12.2f} {ratio:>7.2f}x{flag}"  # noqa: E501
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with this JSON baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="max allowed ratio of current median to baseline median",
+    )
+    parser.add_argument("--filter", help="only run benchmarks containing this text")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--min-rounds", type=int, default=5)
+    parser.add_argument(
+        "--verbose", action="store_true", help="keep the bot's info logging on"
+    )
+    args = parser.parse_args()
+
+    if not args.verbose:
+        getlogger().setLevel(logging.WARNING)
+
+    results = asyncio.run(run(args))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "machine": {
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                    },
+                    "benchmarks": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"\nresults saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,640 @@
+"""
+End to end load test of the bot against a fake Matrix homeserver
+and a fake OpenAI compatible chat/completions server.
+
+The fake servers run in this process, the bot runs in a child process
+so its peak RSS can be measured on its own. Every synthetic user sends
+a message, waits for the bot's reply, then sends the next one.
+
+usage:
+python benchmarks/load_test.py --rooms 20 --users 5 --messages 10
+python benchmarks/load_test.py --command "!gpt" --latency 0.5 --error-rate 0.05
+python benchmarks/load_test.py --set stream_reply=true --chunks 50 --chunk-rate 20
+python benchmarks/load_test.py --set max_concurrent_requests=4 --json result.json
+
+--set passes extra keyword arguments to Bot, values are parsed as JSON
+when possible. Latency is measured from the sync response that delivers
+a message to the bot until the first and the last room_send related to it.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import random
+import resource
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from typing import Optional
+from urllib.parse import unquote
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from aiohttp import web  # noqa: E402
+
+BOT_USER_ID = "@bot:localhost"
+BOT_DEVICE_ID = "LOADTEST"
+SERVER_NAME = "localhost"
+
+# 1x1 png, served for every media download
+PNG_PIXEL = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360f8cfc0f01f0005000201e2"
+    "2a3a5d0000000049454e44ae426082"
+)
+
+
+class FakeOpenAI:
+    """
+    OpenAI compatible /v1/chat/completions
+
+    latency: seconds before the response starts
+    chunks: number of content chunks of a reply
+    chunk_rate: streamed chunks per second, 0 for no delay
+    error_rate: fraction of requests answered with error_status
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        chunks: int = 20,
+        chunk_rate: float = 50.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+    ) -> None:
+        self.latency = latency
+        self.chunks = chunks
+        self.chunk_rate = chunk_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+        self.requests = 0
+        self.streamed = 0
+        self.errors = 0
+        self.inflight = 0
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.inflight += 1
+        try:
+            return await self.respond(request)
+        finally:
+            self.inflight -= 1
+
+    async def respond(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "injected error", "type": "server_error"}},
+                status=self.error_status,
+            )
+
+        words = [f"word{i} " for i in range(self.chunks)]
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": "chatcmpl-loadtest",
+                    "object": "chat.completion",
+                    "model": body.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(words)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 10,
+                        "completion_tokens": self.chunks,
+                        "total_tokens": 10 + self.chunks,
+                    },
+                }
+            )
+
+        self.streamed += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        deltas = [{"role": "assistant"}] + [{"content": word} for word in words]
+        for delta in deltas:
+            chunk = {
+                "id": "chatcmpl-loadtest",
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.chunk_rate:
+                await asyncio.sleep(1 / self.chunk_rate)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class Message:
+    """
+    A synthetic user message and the bot's replies to it
+    """
+
+    def __init__(self, event: dict) -> None:
+        self.event = event
+        self.created_at = time.monotonic()
+        self.delivered_at: Optional[float] = None
+        self.first_reply_at: Optional[float] = None
+        self.last_reply_at: Optional[float] = None
+        self.replies = 0
+        # event id of the first reply, follow ups in a thread reply to it
+        self.reply_event_id: Optional[str] = None
+        self.replied = asyncio.Event()
+
+
+class FakeHomeserver:
+    """
+    The subset of the Matrix client-server API used by the bot:
+    sync, send, typing, event, media and the e2ee key endpoints
+    """
+
+    def __init__(self, rooms: dict[str, list[str]]) -> None:
+        # room_id -> user ids
+        self.rooms = rooms
+
+        self.batch = 0
+        self.event_counter = 0
+        self.media_counter = 0
+        # room_id -> events waiting for the next sync
+        self.pending: dict[str, list[dict]] = {room_id: [] for room_id in rooms}
+        self.new_events = asyncio.Event()
+        self.initial_synced = asyncio.Event()
+
+        # event_id -> message, of user messages and of the bot's replies
+        self.messages: dict[str, Message] = {}
+        self.events: dict[str, dict] = {}
+
+        self.sends = 0
+        self.edits = 0
+        self.typing = 0
+        self.unmatched_sends = 0
+        self.downloads = 0
+        self.event_fetches = 0
+
+        self.app = web.Application()
+        routes = [
+            web.get("/_matrix/client/versions", self.versions),
+            web.get("/_matrix/client/v3/account/whoami", self.whoami),
+            web.get("/_matrix/client/v3/sync", self.sync),
+            web.put(
+                "/_matrix/client/v3/rooms/{room_id}/send/{event_type}/{txn_id}",
+                self.send,
+            ),
+            web.put("/_matrix/client/v3/rooms/{room_id}/typing/{user_id}", self.typing_),
+            web.get("/_matrix/client/v3/rooms/{room_id}/event/{event_id}", self.event),
+            web.post("/_matrix/client/v3/keys/upload", self.keys_upload),
+            web.post("/_matrix/client/v3/keys/query", self.keys_query),
+            web.post("/_matrix/media/v3/upload", self.upload),
+            web.get("/_matrix/client/v1/media/download/{tail:.*}", self.download),
+            web.get("/_matrix/media/v3/download/{tail:.*}", self.download),
+        ]
+        self.app.add_routes(routes)
+
+    def next_event_id(self) -> str:
+        self.event_counter += 1
+        return f"$event{self.event_counter}"
+
+    def state_events(self, room_id: str) -> list[dict]:
+        events = [
+            {
+                "type": "m.room.create",
+                "event_id": self.next_event_id(),
+                "sender": BOT_USER_ID,
+                "origin_server_ts": int(time.time() * 1000),
+                "state_key": "",
+                "content": {"creator": BOT_USER_ID},
+            }
+        ]
+        for user_id in [BOT_USER_ID] + self.rooms[room_id]:
+            events.append(
+                {
+                    "type": "m.room.member",
+                    "event_id": self.next_event_id(),
+                    "sender": user_id,
+                    "origin_server_ts": int(time.time() * 1000),
+                    "state_key": user_id,
+                    "content": {"membership": "join", "displayname": user_id},
+                }
+            )
+        return events
+
+    def post_message(self, room_id: str, sender: str, content: dict) -> Message:
+        """
+        Queue a message for the bot's next sync
+        """
+        event = {
+            "type": "m.room.message",
+            "event_id": self.next_event_id(),
+            "sender": sender,
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": room_id,
+            "content": content,
+        }
+        message = Message(event)
+        self.messages[event["event_id"]] = message
+        self.events[event["event_id"]] = event
+        self.pending[room_id].append(event)
+        self.new_events.set()
+        return message
+
+    async def versions(self, request: web.Request) -> web.Response:
+        return web.json_response({"versions": ["v1.1", "v1.11"]})
+
+    async def whoami(self, request: web.Request) -> web.Response:
+        return web.json_response({"user_id": BOT_USER_ID, "device_id": BOT_DEVICE_ID})
+
+    async def sync(self, request: web.Request) -> web.Response:
+        since = request.query.get("since")
+        timeout = int(request.query.get("timeout", 0)) / 1000
+
+        join = {}
+        if since is None:
+            for room_id in self.rooms:
+                join[room_id] = self.room_update(self.state_events(room_id), [])
+        else:
+            if not any(self.pending.values()):
+                self.new_events.clear()
+                try:
+                    await asyncio.wait_for(self.new_events.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            now = time.monotonic()
+            for room_id, events in self.pending.items():
+                if not events:
+                    continue
+                for event in events:
+                    message = self.messages.get(event["event_id"])
+                    # the bot's own events map to the message they reply to
+                    if message is not None and message.event is event:
+                        message.delivered_at = now
+                join[room_id] = self.room_update([], events)
+                self.pending[room_id] = []
+
+        self.batch += 1
+        if since is None:
+            self.initial_synced.set()
+        return web.json_response(
+            {
+                "next_batch": f"s{self.batch}",
+                "rooms": {"join": join, "invite": {}, "leave": {}},
+                "to_device": {"events": []},
+                "presence": {"events": []},
+                "account_data": {"events": []},
+                "device_lists": {"changed": [], "left": []},
+                "device_one_time_keys_count": {"signed_curve25519": 50},
+            }
+        )
+
+    def room_update(self, state: list[dict], timeline: list[dict]) -> dict:
+        return {
+            "state": {"events": state},
+            "timeline": {"events": timeline, "limited": False, "prev_batch": "p"},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+            "summary": {},
+            "unread_notifications": {},
+        }
+
+    async def send(self, request: web.Request) -> web.Response:
+        content = await request.json()
+        now = time.monotonic()
+        event_id = self.next_event_id()
+        self.sends += 1
+
+        relates_to = content.get("m.relates_to", {})
+        if relates_to.get("rel_type") == "m.replace":
+            self.edits += 1
+            message = self.messages.get(relates_to.get("event_id"))
+        else:
+            message = self.messages.get(
+                relates_to.get("m.in_reply_to", {}).get("event_id")
+            )
+        if message is None:
+            self.unmatched_sends += 1
+        else:
+            # edits of this reply are attributed to the same user message
+            self.messages[event_id] = message
+            if message.first_reply_at is None:
+                message.first_reply_at = now
+                message.reply_event_id = event_id
+                message.replied.set()
+            message.last_reply_at = now
+            message.replies += 1
+
+        room_id = unquote(request.match_info["room_id"])
+        event = {
+            "type": request.match_info["event_type"],
+            "event_id": event_id,
+            "sender": BOT_USER_ID,
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": room_id,
+            "content": content,
+        }
+        self.events[event_id] = event
+        # like a real homeserver, the bot syncs its own messages too
+        self.pending[room_id].append(event)
+        self.new_events.set()
+        return web.json_response({"event_id": event_id})
+
+    async def typing_(self, request: web.Request) -> web.Response:
+        self.typing += 1
+        return web.json_response({})
+
+    async def event(self, request: web.Request) -> web.Response:
+        self.event_fetches += 1
+        event = self.events.get(unquote(request.match_info["event_id"]))
+        if event is None:
+            return web.json_response(
+                {"errcode": "M_NOT_FOUND", "error": "Event not found"}, status=404
+            )
+        return web.json_response(event)
+
+    async def keys_upload(self, request: web.Request) -> web.Response:
+        return web.json_response({"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def keys_query(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(
+            {"device_keys": {user_id: {} for user_id in body["device_keys"]}, "failures": {}}  # noqa: E501
+        )
+
+    async def upload(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.media_counter += 1
+        return web.json_response(
+            {"content_uri": f"mxc://{SERVER_NAME}/media{self.media_counter}"}
+        )
+
+    async def download(self, request: web.Request) -> web.Response:
+        self.downloads += 1
+        return web.Response(body=PNG_PIXEL, content_type="image/png")
+
+
+def run_bot(
+    homeserver: str, api_endpoint: str, workdir: str, options: dict, verbose: bool
+) -> None:
+    """
+    Entry point of the bot process
+    """
+    # context.db and bot.log are created in the working directory
+    os.chdir(workdir)
+    asyncio.run(_run_bot(homeserver, api_endpoint, workdir, options, verbose))
+
+
+async def _run_bot(
+    homeserver: str, api_endpoint: str, workdir: str, options: dict, verbose: bool
+) -> None:
+    import logging
+
+    from bot import Bot
+    from log import getlogger
+
+    if not verbose:
+        getlogger().setLevel(logging.WARNING)
+
+    bot = Bot(
+        homeserver=homeserver,
+        user_id=BOT_USER_ID,
+        device_id=BOT_DEVICE_ID,
+        access_token="load-test",
+        openai_api_key="load-test",
+        gpt_api_endpoint=api_endpoint,
+        **options,
+    )
+    # keep the sync store out of the repository
+    bot.client.store_path = workdir
+    await bot.login()
+    await bot.start_metrics_server()
+    await bot.prewarm_connections()
+
+    sync_task = asyncio.create_task(bot.sync_forever(timeout=30000, full_state=True))
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(
+        signal.SIGTERM, lambda: asyncio.create_task(bot.close(sync_task))
+    )
+    try:
+        await sync_task
+    except asyncio.CancelledError:
+        pass
+
+
+async def user_session(
+    homeserver: FakeHomeserver,
+    room_id: str,
+    user_id: str,
+    args,
+    sent: list[Message],
+) -> None:
+    thread_root_id = None
+    last_reply_id = None
+    for i in range(args.messages):
+        body = f"{args.command} message {i} from {user_id}".strip()
+        content = {"msgtype": "m.text", "body": body}
+        if args.command == BOT_USER_ID and thread_root_id is None:
+            # mention the bot to start a thread
+            content["m.mentions"] = {"user_ids": [BOT_USER_ID]}
+        elif args.command == BOT_USER_ID:
+            # then keep chatting in the thread, replying to the bot
+            content["m.relates_to"] = {
+                "rel_type": "m.thread",
+                "event_id": thread_root_id,
+                "is_falling_back": True,
+                "m.in_reply_to": {"event_id": last_reply_id},
+            }
+        message = homeserver.post_message(room_id, user_id, content)
+        sent.append(message)
+        try:
+            await asyncio.wait_for(message.replied.wait(), args.reply_timeout)
+        except asyncio.TimeoutError:
+            pass
+        if message.reply_event_id is not None:
+            thread_root_id = thread_root_id or message.event["event_id"]
+            last_reply_id = message.reply_event_id
+        if args.think_time:
+            await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    if len(values) == 1:
+        values = values * 2
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": round(cuts[49] * 1000, 1),
+        "p95": round(cuts[94] * 1000, 1),
+        "p99": round(cuts[98] * 1000, 1),
+        "max": round(max(values) * 1000, 1),
+    }
+
+
+async def start_site(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def parse_options(pairs: list[str]) -> dict:
+    options = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        try:
+            options[key] = json.loads(value)
+        except json.JSONDecodeError:
+            options[key] = value
+    return options
+
+
+async def run(args) -> dict:
+    # !chat conversations are per sender, so users are not shared between rooms
+    rooms = {
+        f"!room{i}:{SERVER_NAME}": [
+            f"@user{i}-{j}:{SERVER_NAME}" for j in range(args.users)
+        ]
+        for i in range(args.rooms)
+    }
+
+    homeserver = FakeHomeserver(rooms)
+    openai = FakeOpenAI(
+        latency=args.latency,
+        chunks=args.chunks,
+        chunk_rate=args.chunk_rate,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    homeserver_runner, homeserver_url = await start_site(homeserver.app)
+    openai_runner, openai_url = await start_site(openai.app)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # a fresh interpreter, forking a process with a running loop is unsafe
+        context = multiprocessing.get_context("spawn")
+        bot_process = context.Process(
+            target=run_bot,
+            args=(
+                homeserver_url,
+                openai_url + "/v1/chat/completions",
+                workdir,
+                parse_options(args.set),
+                args.verbose,
+            ),
+        )
+        bot_process.start()
+        await asyncio.wait_for(homeserver.initial_synced.wait(), args.startup_timeout)
+
+        sent: list[Message] = []
+        start = time.monotonic()
+        await asyncio.gather(
+            *[
+                user_session(homeserver, room_id, user_id, args, sent)
+                for room_id, users in rooms.items()
+                for user_id in users
+            ]
+        )
+        active = time.monotonic() - start
+        # wait for streams still running and the trailing edits of their replies
+        while openai.inflight:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(args.drain)
+
+        bot_process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, bot_process.join)
+
+    await homeserver_runner.cleanup()
+    await openai_runner.cleanup()
+
+    replied = [m for m in sent if m.first_reply_at is not None]
+    first_reply = [m.first_reply_at - m.delivered_at for m in replied]
+    last_reply = [m.last_reply_at - m.delivered_at for m in replied]
+    delivery = [m.delivered_at - m.created_at for m in sent if m.delivered_at]
+    return {
+        "rooms": args.rooms,
+        "users_per_room": args.users,
+        "messages": len(sent),
+        "replied": len(replied),
+        "timed_out": len(sent) - len(replied),
+        "seconds": round(active, 2),
+        "throughput_per_s": round(len(replied) / active, 2) if active else 0.0,
+        "first_reply_ms": percentiles(first_reply),
+        "last_reply_ms": percentiles(last_reply),
+        "sync_delivery_ms": percentiles(delivery),
+        "homeserver": {
+            "sends": homeserver.sends,
+            "edits": homeserver.edits,
+            "typing": homeserver.typing,
+            "unmatched_sends": homeserver.unmatched_sends,
+            "event_fetches": homeserver.event_fetches,
+            "syncs": homeserver.batch,
+        },
+        "openai": {
+            "requests": openai.requests,
+            "streamed": openai.streamed,
+            "injected_errors": openai.errors,
+        },
+        # kilobytes on linux
+        "bot_peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+        ),
+        "bot_exitcode": bot_process.exitcode,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--users", type=int, default=3, help="users per room")
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument(
+        "--command",
+        default="!chat",
+        help=f'message prefix, e.g. "!chat" "!gpt" or "{BOT_USER_ID}" for threads',
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0.0, help="avg seconds between messages"
+    )
+    parser.add_argument("--reply-timeout", type=float, default=60.0)
+    parser.add_argument(
+        "--drain", type=float, default=1.0, help="seconds to wait for trailing sends"
+    )
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-rate", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra Bot keyword argument",
+    )
+    parser.add_argument("--json", help="write the report to this JSON file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Compare the old truncate loop with Chatbot.__truncate_conversation
+on long conversations.
+
+usage: python benchmarks/truncate_benchmark.py [--messages 1000] [--repeat 5]
+"""
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import httpx  # noqa: E402
+
+from conversation_cache import Conversation  # noqa: E402
+from gptbot import Chatbot  # noqa: E402
+
+
+def legacy_token_count(encoding, messages: list[dict]) -> int:
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 5
+        for key, value in message.items():
+            if value:
+                num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += 5
+    num_tokens += 5
+    return num_tokens
+
+
+def legacy_truncate(encoding, messages: list[dict], truncate_limit: int) -> None:
+    # the loop used before the one pass truncation
+    while True:
+        if (
+            legacy_token_count(encoding, messages) > truncate_limit
+            and len(messages) > 1
+        ):
+            messages.pop(1)
+        else:
+            break
+
+
+def build_messages(chatbot: Chatbot, convo_id: str, num_messages: int) -> None:
+    chatbot.reset(convo_id=convo_id)
+    for i in range(num_messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        chatbot.add_to_conversation(
+            f"message {i}: " + "the quick brown fox jumps over the lazy dog " * 4,
+            role,
+            convo_id=convo_id,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        chatbot = Chatbot(
+            aclient=httpx.AsyncClient(),
+            api_key="benchmark",
+            engine="gpt-3.5-turbo",
+            db_path=os.path.join(tmpdir, "context.db"),
+        )
+        build_messages(chatbot, "benchmark", args.messages)
+        messages = list(chatbot.conversation["benchmark"].messages)
+        token_counts = list(chatbot.conversation["benchmark"].tokens)
+        # drop roughly half of the conversation
+        truncate_limit = chatbot.get_token_count("benchmark") // 2
+
+        legacy_times = []
+        for _ in range(args.repeat):
+            legacy_messages = list(messages)
+            start = time.perf_counter()
+            legacy_truncate(chatbot.encoding, legacy_messages, truncate_limit)
+            legacy_times.append(time.perf_counter() - start)
+
+        current_times = []
+        chatbot.truncate_limit = truncate_limit
+        for _ in range(args.repeat):
+            chatbot.conversation["benchmark"] = Conversation(
+                list(messages), list(token_counts)
+            )
+            start = time.perf_counter()
+            chatbot._Chatbot__truncate_conversation("benchmark")
+            current_times.append(time.perf_counter() - start)
+
+        assert chatbot.conversation["benchmark"].messages == legacy_messages
+
+        chatbot.close()
+
+    legacy = min(legacy_times)
+    current = min(current_times)
+    print(f"messages: {args.messages}, removed: {args.messages + 1 - len(legacy_messages)}")  # noqa: E501
+    print(f"legacy loop: {legacy * 1000:.2f} ms")
+    print(f"one pass:    {current * 1000:.2f} ms")
+    print(f"speedup:     {legacy / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Peak memory of building one vision request body, the old way with
+base64.b64encode, an f-string data url and json.dumps of the payload,
+against encode_data_url and the streamed VisionPayload.
+
+usage:
+python benchmarks/vision_memory.py
+python benchmarks/vision_memory.py --sizes 1 5 20 --json result.json
+
+Peaks are measured with tracemalloc and exclude the downloaded image itself.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+from pathlib import Path
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from vision_payload import VisionPayload, encode_data_url  # noqa: E402
+
+MODEL = "gpt-4o"
+PROMPT = "What is in this image?"
+MIMETYPE = "image/jpeg"
+MB = 1024 * 1024
+
+
+def old_body(body: bytes) -> int:
+    b64_image = base64.b64encode(body).decode("utf-8")
+    image_url = f"data:{MIMETYPE};base64,{b64_image}"
+    payload = {
+        "model": MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            }
+        ],
+    }
+    # what httpx does with json=payload
+    content = json.dumps(
+        payload, ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    ).encode("utf-8")
+    return len(content)
+
+
+async def new_body(body: bytes) -> int:
+    payload = VisionPayload(MODEL, PROMPT, encode_data_url(body, MIMETYPE))
+    # what httpx does with content=payload
+    sent = 0
+    async for chunk in payload:
+        sent += len(chunk)
+    return sent
+
+
+def measure(fn, body: bytes) -> tuple[int, int]:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = fn(body)
+    if asyncio.iscoroutine(result):
+        result = asyncio.run(result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+
+def check_equal(body: bytes) -> None:
+    async def collect() -> bytes:
+        payload = VisionPayload(MODEL, PROMPT, encode_data_url(body, MIMETYPE))
+        return b"".join([chunk async for chunk in payload])
+
+    streamed = json.loads(asyncio.run(collect()))
+    url = streamed["messages"][0]["content"][1]["image_url"]["url"]
+    assert url == f"data:{MIMETYPE};base64,{base64.b64encode(body).decode()}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=float, nargs="+", default=[1, 5, 20], help="image sizes in MB"
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'image':>8} {'body':>8} {'old peak':>10} {'new peak':>10} {'saved':>7}")
+    for size in args.sizes:
+        body = os.urandom(int(size * MB))
+        check_equal(body)
+        old_len, old_peak = measure(old_body, body)
+        new_len, new_peak = measure(new_body, body)
+        results.append(
+            {
+                "image_mb": size,
+                "body_mb": round(new_len / MB, 2),
+                "old_peak_mb": round(old_peak / MB, 2),
+                "new_peak_mb": round(new_peak / MB, 2),
+            }
+        )
+        print(
+            f"{size:>6.1f}MB {new_len / MB:>6.1f}MB {old_peak / MB:>8.1f}MB "
+            f"{new_peak / MB:>8.1f}MB {1 - new_peak / old_peak:>6.0%}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
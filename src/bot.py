@@ -1,14 +1,12 @@
 import asyncio
+import contextlib
+import json
 import os
 from pathlib import Path
 import re
 import sys
 import traceback
 from typing import Union, Optional
-import aiofiles.os
-import base64
-
-import httpx
 
 from nio import (
     AsyncClient,
@@ -26,6 +24,7 @@ from nio import (
     LoginResponse,
     MatrixRoom,
     MegolmEvent,
+    RoomMessage,
     RoomMessageText,
     ToDeviceError,
     WhoamiResponse,
@@ -35,16 +34,37 @@ from nio.api import Api
 
 from log import getlogger
 from send_image import send_room_image
-from send_message import send_room_message
+from send_message import send_room_message, send_room_message_stream
 from flowise import flowise_query
 from lc_manager import LCManager
 from gptbot import Chatbot
-from gpt_vision import gpt_vision_query
+from gpt_vision import gpt_vision_query, gpt_vision_query_stream
+from scheduler import ConversationLanes, RequestScheduler
+from response_cache import ResponseCache, make_key
+from event_cache import EventCache
+from media_cache import MediaCache
+from image_pool import ImagePool, ImagePoolFull
+from image_preprocess import ImagePreprocessor
+from image_scheduler import ImageJobScheduler
+from vision_payload import encode_data_url
+from metrics import (
+    IMAGE_JOBS_INFLIGHT,
+    IMAGE_JOBS_PENDING,
+    IMAGE_JOBS_QUEUED,
+    REGISTRY,
+    REQUESTS_INFLIGHT,
+    REQUESTS_QUEUED,
+    MetricsServer,
+    timed_command,
+    track_event,
+)
+from http_pools import UPSTREAMS, HTTPPools
 import imagegen
 
 logger = getlogger()
 DEVICE_NAME = "MatrixChatGPTBot"
 GENERAL_ERROR_MESSAGE = "Something went wrong, please try again or contact admin."
+BUSY_MESSAGE = "The bot is busy right now, please try again later."
 INVALID_NUMBER_OF_PARAMETERS_MESSAGE = "Invalid number of parameters"
 
 
@@ -74,6 +94,10 @@ class Bot:
         image_generation_backend: Optional[str] = None,
         image_generation_size: Optional[str] = None,
         image_format: Optional[str] = None,
+        image_save_dir: Optional[str] = None,
+        image_generation_concurrency: Optional[int] = None,
+        image_generation_max_batch: Optional[int] = None,
+        image_generation_max_queue: Optional[int] = None,
         sdwui_steps: Optional[int] = None,
         sdwui_sampler_name: Optional[str] = None,
         sdwui_cfg_scale: Optional[float] = None,
@@ -81,6 +105,46 @@ class Bot:
         gpt_vision_api_endpoint: Optional[str] = None,
         timeout: Union[float, None] = None,
         custom_help_message: Optional[str] = None,
+        conversation_cache_size: Optional[int] = None,
+        conversation_cache_bytes: Optional[int] = None,
+        db_flush_interval: Optional[float] = None,
+        db_synchronous: Optional[str] = None,
+        stream_reply: Optional[bool] = None,
+        stream_edit_interval: Optional[float] = None,
+        stream_edit_min_chars: Optional[int] = None,
+        max_concurrent_requests: Optional[int] = None,
+        max_queued_requests: Optional[int] = None,
+        max_queued_requests_per_room: Optional[int] = None,
+        response_cache_commands: Optional[list[str]] = None,
+        response_cache_size: Optional[int] = None,
+        response_cache_ttl: Optional[float] = None,
+        response_cache_max_temperature: Optional[float] = None,
+        tokenizer_cache_dir: Optional[str] = None,
+        metrics_host: Optional[str] = None,
+        metrics_port: Optional[int] = None,
+        http2: Optional[bool] = None,
+        http_pool_limits: Optional[dict[str, dict]] = None,
+        http_prewarm: Optional[bool] = None,
+        gpt_api_endpoints: Optional[list[dict]] = None,
+        endpoint_failure_threshold: Optional[int] = None,
+        endpoint_reset_timeout: Optional[float] = None,
+        endpoint_failover_timeout: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        hedge_budget: Optional[float] = None,
+        openai_api_keys: Optional[list[str]] = None,
+        rate_limit_max_wait: Optional[float] = None,
+        rate_limit_release_interval: Optional[float] = None,
+        event_cache_size: Optional[int] = None,
+        media_cache_bytes: Optional[int] = None,
+        media_cache_dir: Optional[str] = None,
+        media_cache_disk_bytes: Optional[int] = None,
+        vision_image_max_side: Optional[int] = None,
+        vision_image_quality: Optional[int] = None,
+        vision_image_format: Optional[str] = None,
+        image_workers: Optional[int] = None,
+        image_pool: Optional[str] = None,
+        image_queue_size: Optional[int] = None,
+        vision_max_image_bytes: Optional[int] = None,
     ):
         if homeserver is None or user_id is None or device_id is None:
             logger.error("homeserver && user_id && device_id is required")
@@ -105,6 +169,54 @@ class Bot:
             )
             sys.exit(1)
 
+        if db_synchronous not in ["OFF", "NORMAL", "FULL", "EXTRA", None]:
+            logger.error(
+                "db_synchronous should be OFF or NORMAL or FULL or EXTRA, leave blank for NORMAL"  # noqa: E501
+            )
+            sys.exit(1)
+
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.error("http2 requires the h2 package: pip install httpx[http2]")
+                sys.exit(1)
+
+        if isinstance(http_pool_limits, str):
+            http_pool_limits = json.loads(http_pool_limits)
+        for upstream in http_pool_limits or {}:
+            if upstream not in UPSTREAMS:
+                logger.error(f"http_pool_limits keys should be one of {UPSTREAMS}")
+                sys.exit(1)
+
+        if isinstance(gpt_api_endpoints, str):
+            gpt_api_endpoints = json.loads(gpt_api_endpoints)
+        for endpoint in gpt_api_endpoints or []:
+            if not isinstance(endpoint, dict) or "url" not in endpoint:
+                logger.error("each of gpt_api_endpoints should be an object with a url")
+                sys.exit(1)
+
+        if isinstance(openai_api_keys, str):
+            openai_api_keys = [key.strip() for key in openai_api_keys.split(",")]
+        if openai_api_keys and openai_api_key is None:
+            openai_api_key = openai_api_keys[0]
+
+        if vision_image_format not in ["jpeg", "webp", None]:
+            logger.error(
+                "vision_image_format should be jpeg or webp, leave blank for jpeg"
+            )
+            sys.exit(1)
+
+        if image_pool not in ["thread", "process", None]:
+            logger.error(
+                "image_pool should be thread or process, leave blank for thread"
+            )
+            sys.exit(1)
+
+        if hedge_percentile and not 0 < hedge_percentile < 100:
+            logger.error("hedge_percentile should be between 0 and 100, leave blank to disable")  # noqa: E501
+            sys.exit(1)
+
         self.homeserver: str = homeserver
         self.user_id: str = user_id
         self.password: str = password
@@ -154,10 +266,111 @@ class Bot:
         self.sdwui_sampler_name = sdwui_sampler_name
         self.sdwui_cfg_scale = sdwui_cfg_scale
 
+        # queue !pic in front of the backend, sdwui generates identical
+        # queued jobs in one call with batch_size
+        self.image_scheduler = ImageJobScheduler(
+            self.generate_images,
+            concurrency=image_generation_concurrency or 1,
+            max_batch=(image_generation_max_batch or 4)
+            if image_generation_backend == "sdwui"
+            else 1,
+            max_queue=image_generation_max_queue
+            if image_generation_max_queue is not None
+            else 20,
+        )
+
         self.timeout: float = timeout or 120.0
 
+        # 0 means unlimited
+        self.conversation_cache_size: int = (
+            conversation_cache_size if conversation_cache_size is not None else 1000
+        )
+        self.conversation_cache_bytes: int = conversation_cache_bytes or 0
+        self.db_flush_interval: float = (
+            db_flush_interval if db_flush_interval is not None else 0.05
+        )
+        self.db_synchronous: str = db_synchronous or "NORMAL"
+
+        # post the reply as soon as the first chunk arrives, then edit it
+        self.stream_reply: bool = stream_reply or False
+        self.stream_edit_interval: float = stream_edit_interval or 1.5
+        self.stream_edit_min_chars: int = stream_edit_min_chars or 80
+
+        # limit upstream requests started from message_callback
+        self.scheduler = RequestScheduler(
+            max_inflight=max_concurrent_requests or 16,
+            max_queue=max_queued_requests if max_queued_requests is not None else 100,
+            max_queue_per_room=max_queued_requests_per_room
+            if max_queued_requests_per_room is not None
+            else 20,
+        )
+        # turns of one conversation run in order
+        self.lanes = ConversationLanes()
+
+        # cache one shot responses of these commands: gpt, lc
+        if isinstance(response_cache_commands, str):
+            response_cache_commands = list(
+                filter(None, response_cache_commands.replace(" ", "").split(","))
+            )
+        self.response_cache_commands: list[str] = response_cache_commands or []
+        # only cache !gpt when the sampling temperature is not above this
+        self.response_cache_max_temperature: float = (
+            response_cache_max_temperature
+            if response_cache_max_temperature is not None
+            else 1.0
+        )
+        self.response_cache = ResponseCache(
+            max_entries=response_cache_size or 256,
+            ttl=response_cache_ttl or 300.0,
+        )
+
+        # recent events per room, 0 to fetch every replied to event
+        self.event_cache_size: int = (
+            event_cache_size if event_cache_size is not None else 500
+        )
+        self.event_cache = EventCache(max_events=self.event_cache_size)
+
+        # downloaded images for vision, 0 to download every time
+        self.media_cache_bytes: int = (
+            media_cache_bytes if media_cache_bytes is not None else 64 * 1024 * 1024
+        )
+        self.media_cache = MediaCache(
+            max_bytes=self.media_cache_bytes,
+            spill_dir=media_cache_dir,
+            max_disk_bytes=media_cache_disk_bytes or 512 * 1024 * 1024,
+        )
+
+        # larger images are not downloaded for vision
+        self.vision_max_image_bytes: int = (
+            vision_max_image_bytes or 20 * 1024 * 1024
+        )
+        # decode and encode images off the event loop
+        self.image_pool = ImagePool(
+            kind=image_pool or "thread",
+            workers=image_workers or 2,
+            max_queue=image_queue_size if image_queue_size is not None else 32,
+        )
+        # downscale and recompress images for vision, off without a max side
+        self.image_preprocessor: Optional[ImagePreprocessor] = (
+            ImagePreprocessor(
+                self.image_pool,
+                max_side=vision_image_max_side,
+                quality=vision_image_quality or 85,
+                format=vision_image_format or "jpeg",
+            )
+            if vision_image_max_side
+            else None
+        )
+
         self.base_path = Path(os.path.dirname(__file__)).parent
 
+        # tiktoken BPE files, the bundled cache is used if present
+        if tokenizer_cache_dir is None and os.path.isdir(
+            self.base_path / "tiktoken_cache"
+        ):
+            tokenizer_cache_dir = str(self.base_path / "tiktoken_cache")
+        self.tokenizer_cache_dir = tokenizer_cache_dir
+
         self.whitelist_room_id = whitelist_room_id
         if whitelist_room_id is not None:
             if isinstance(whitelist_room_id, str):
@@ -175,13 +388,31 @@ class Bot:
             # intialize LCManager
             self.lc_manager = LCManager()
 
-        if not os.path.exists(self.base_path / "images"):
-            os.mkdir(self.base_path / "images")
-
-        self.httpx_client = httpx.AsyncClient(
-            follow_redirects=True,
+        # keep a copy of generated images, they are only uploaded without it
+        self.image_save_dir: Optional[str] = image_save_dir
+        if image_save_dir is not None:
+            os.makedirs(image_save_dir, exist_ok=True)
+
+        # prometheus metrics endpoint, disabled without a port
+        self.metrics_host: str = metrics_host or "127.0.0.1"
+        self.metrics_port: Optional[int] = metrics_port
+        self.metrics_server: Optional[MetricsServer] = None
+        REQUESTS_INFLIGHT.set_function(lambda: self.scheduler.inflight)
+        REQUESTS_QUEUED.set_function(lambda: self.scheduler.queued)
+        IMAGE_JOBS_PENDING.set_function(lambda: self.image_pool.pending)
+        IMAGE_JOBS_INFLIGHT.set_function(lambda: self.image_scheduler.inflight)
+        IMAGE_JOBS_QUEUED.set_function(lambda: self.image_scheduler.queued)
+
+        # one connection pool per upstream
+        self.http2: bool = http2 or False
+        self.http_prewarm: bool = http_prewarm if http_prewarm is not None else True
+        self.http_pools = HTTPPools(
             timeout=self.timeout,
+            limits=http_pool_limits,
+            http2=self.http2,
+            metrics=bool(self.metrics_port),
         )
+        REGISTRY.add_collector(self.http_pools.collect_metrics)
 
         # initialize AsyncClient object
         self.store_path = self.base_path
@@ -201,7 +432,7 @@ class Bot:
 
         # initialize Chatbot object
         self.chatbot = Chatbot(
-            aclient=self.httpx_client,
+            aclient=self.http_pools.get("chat"),
             api_key=self.openai_api_key,
             api_url=self.gpt_api_endpoint,
             engine=self.gpt_model,
@@ -213,9 +444,28 @@ class Bot:
             reply_count=self.reply_count,
             system_prompt=self.system_prompt,
             temperature=self.temperature,
+            conversation_cache_size=self.conversation_cache_size,
+            conversation_cache_bytes=self.conversation_cache_bytes,
+            db_flush_interval=self.db_flush_interval,
+            db_synchronous=self.db_synchronous,
+            tokenizer_cache_dir=self.tokenizer_cache_dir,
+            endpoints=gpt_api_endpoints,
+            endpoint_failure_threshold=endpoint_failure_threshold or 3,
+            endpoint_reset_timeout=endpoint_reset_timeout or 30.0,
+            endpoint_failover_timeout=endpoint_failover_timeout,
+            hedge_percentile=hedge_percentile,
+            hedge_budget=hedge_budget if hedge_budget is not None else 0.05,
+            api_keys=openai_api_keys,
+            rate_limit_max_wait=rate_limit_max_wait or 60.0,
+            rate_limit_release_interval=rate_limit_release_interval
+            if rate_limit_release_interval is not None
+            else 0.1,
         )
+        REGISTRY.add_collector(self.chatbot.router.collect_metrics)
 
         # setup event callbacks
+        if self.event_cache_size:
+            self.client.add_event_callback(self.cache_event, (RoomMessage,))
         self.client.add_event_callback(self.message_callback, (RoomMessageText,))
         self.client.add_event_callback(self.decryption_failure, (MegolmEvent,))
         self.client.add_event_callback(self.invite_callback, (InviteMemberEvent,))
@@ -238,9 +488,28 @@ class Bot:
         self.custom_help_message = custom_help_message
 
     async def close(self, task: asyncio.Task) -> None:
-        self.chatbot.cursor.close()
-        self.chatbot.conn.close()
-        await self.httpx_client.aclose()
+        logger.info(f"Request scheduler stats: {self.scheduler.stats()}")
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.response_cache_commands:
+            logger.info(f"Response cache stats: {self.response_cache.stats()}")
+        if self.event_cache_size:
+            logger.info(f"Event cache stats: {self.event_cache.stats()}")
+        if self.media_cache_bytes:
+            logger.info(f"Media cache stats: {self.media_cache.stats()}")
+        if self.image_preprocessor is not None:
+            logger.info(f"Vision image stats: {self.image_preprocessor.stats()}")
+        if self.image_generation_endpoint is not None:
+            logger.info(f"Image job stats: {self.image_scheduler.stats()}")
+        logger.info(f"Image pool stats: {self.image_pool.stats()}")
+        self.image_pool.close()
+        logger.info(f"HTTP pool stats: {self.http_pools.stats()}")
+        logger.info(f"Chat endpoint stats: {self.chatbot.router.stats()}")
+        logger.info(f"Rate limiter stats: {self.chatbot.rate_limiter.stats()}")
+        if self.chatbot.hedging is not None:
+            logger.info(f"Hedged request stats: {self.chatbot.hedging.stats()}")
+        self.chatbot.close()
+        await self.http_pools.aclose()
         if self.lc_admin is not None:
             self.lc_manager.c.close()
             self.lc_manager.conn.close()
@@ -249,6 +518,11 @@ class Bot:
         logger.info("Bot closed!")
 
     # message_callback RoomMessageText event
+    async def cache_event(self, room: MatrixRoom, event: RoomMessage) -> None:
+        # keep the event as the homeserver serves it, decrypted events differ
+        if not event.decrypted:
+            self.event_cache.put(room.room_id, event.source)
+
     async def message_callback(self, room: MatrixRoom, event: RoomMessageText) -> None:
         if self.whitelist_room_id is not None:
             if room.room_id not in self.whitelist_room_id:
@@ -267,6 +541,9 @@ class Bot:
         # user_message
         raw_user_message = event.body
 
+        # for the reply lag metric
+        track_event(event.event_id, event.server_timestamp)
+
         # print info to console
         logger.info(
             f"Message received in room {room.display_name}\n"
@@ -313,37 +590,41 @@ class Bot:
                                         image_mimetype = event_info["content"]["info"][
                                             "mimetype"
                                         ]
-                                        url = event_info["content"]["url"]
-                                        resp = await self.download_mxc(url)
-                                        if isinstance(resp, DownloadError):
-                                            logger.error("Download of image failed")
-                                        else:
-                                            b64_image = base64.b64encode(
-                                                resp.body
-                                            ).decode("utf-8")
-                                            image_url = f"data:{image_mimetype};base64,{b64_image}"
-                                            asyncio.create_task(
-                                                self.gpt_vision_cmd(
-                                                    room_id,
-                                                    reply_to_event_id,
-                                                    prompt,
-                                                    image_url,
-                                                    sender_id,
-                                                    raw_user_message,
-                                                )
-                                            )
-                                            return
+                                        await self.schedule(
+                                            room_id,
+                                            reply_to_event_id,
+                                            sender_id,
+                                            raw_user_message,
+                                            self.gpt_vision_cmd(
+                                                room_id,
+                                                reply_to_event_id,
+                                                prompt,
+                                                event_info["content"]["url"],
+                                                image_mimetype,
+                                                event_info["content"]["info"].get(
+                                                    "size"
+                                                ),
+                                                sender_id,
+                                                raw_user_message,
+                                            ),
+                                        )
+                                        return
                         # thread level chatting
                         else:
                             try:
-                                asyncio.create_task(
+                                await self.schedule(
+                                    room_id,
+                                    reply_to_event_id,
+                                    sender_id,
+                                    raw_user_message,
                                     self.thread_chat(
                                         room_id,
                                         reply_to_event_id,
                                         sender_id=sender_id,
                                         thread_root_id=reply_to_event_id,
                                         prompt=content_body,
-                                    )
+                                    ),
+                                    lane=reply_to_event_id,
                                 )
                             except Exception as e:
                                 logger.error(e)
@@ -377,54 +658,55 @@ class Bot:
                                     "mimetype"
                                 ]
                                 url = event_info["content"]["url"]
-                                resp = await self.download_mxc(url)
-                                if isinstance(resp, DownloadError):
-                                    logger.error("Download of image failed")
-                                else:
-                                    b64_image = base64.b64encode(resp.body).decode(
-                                        "utf-8"
-                                    )
-                                    image_url = (
-                                        f"data:{image_mimetype};base64,{b64_image}"
-                                    )
+                                image_size = event_info["content"]["info"].get("size")
+                                if "rel_type" in event_source["content"]["m.relates_to"]:
                                     if (
-                                        "rel_type"
-                                        in event_source["content"]["m.relates_to"]
+                                        "m.thread"
+                                        == event_source["content"]["m.relates_to"][
+                                            "rel_type"
+                                        ]
                                     ):
-                                        if (
-                                            "m.thread"
-                                            == event_source["content"]["m.relates_to"][
-                                                "rel_type"
-                                            ]
-                                        ):
-                                            thread_root_id = event_source["content"][
-                                                "m.relates_to"
-                                            ]["event_id"]
-                                            asyncio.create_task(
-                                                self.gpt_vision_cmd(
-                                                    room_id,
-                                                    reply_to_event_id,
-                                                    prompt,
-                                                    image_url,
-                                                    sender_id,
-                                                    raw_user_message,
-                                                    reply_in_thread=True,
-                                                    thread_root_id=thread_root_id,
-                                                )
-                                            )
-                                            return
-
-                                    asyncio.create_task(
-                                        self.gpt_vision_cmd(
+                                        thread_root_id = event_source["content"][
+                                            "m.relates_to"
+                                        ]["event_id"]
+                                        await self.schedule(
                                             room_id,
                                             reply_to_event_id,
-                                            prompt,
-                                            image_url,
                                             sender_id,
                                             raw_user_message,
+                                            self.gpt_vision_cmd(
+                                                room_id,
+                                                reply_to_event_id,
+                                                prompt,
+                                                url,
+                                                image_mimetype,
+                                                image_size,
+                                                sender_id,
+                                                raw_user_message,
+                                                reply_in_thread=True,
+                                                thread_root_id=thread_root_id,
+                                            ),
+                                            lane=thread_root_id,
                                         )
-                                    )
-                                    return
+                                        return
+
+                                await self.schedule(
+                                    room_id,
+                                    reply_to_event_id,
+                                    sender_id,
+                                    raw_user_message,
+                                    self.gpt_vision_cmd(
+                                        room_id,
+                                        reply_to_event_id,
+                                        prompt,
+                                        url,
+                                        image_mimetype,
+                                        image_size,
+                                        sender_id,
+                                        raw_user_message,
+                                    ),
+                                )
+                                return
 
             #  element android does not have m.mentions, we use another way to make thread level chatting work
             if "formatted_body" in event_source["content"]:
@@ -433,14 +715,19 @@ class Bot:
                     and "m.relates_to" not in event_source["content"]
                 ):
                     try:
-                        asyncio.create_task(
+                        await self.schedule(
+                            room_id,
+                            reply_to_event_id,
+                            sender_id,
+                            raw_user_message,
                             self.thread_chat(
                                 room_id,
                                 reply_to_event_id,
                                 sender_id=sender_id,
                                 thread_root_id=reply_to_event_id,
                                 prompt=content_body,
-                            )
+                            ),
+                            lane=reply_to_event_id,
                         )
                     except Exception as e:
                         logger.error(e)
@@ -479,27 +766,26 @@ class Bot:
                                     )
                                     if s:
                                         prompt = s.group(1)
-                                        url = event_info["content"]["url"]
-                                        resp = await self.download_mxc(url)
-                                        if isinstance(resp, DownloadError):
-                                            logger.error("Download of image failed")
-                                        else:
-                                            b64_image = base64.b64encode(
-                                                resp.body
-                                            ).decode("utf-8")
-                                            image_url = f"data:{image_mimetype};base64,{b64_image}"
-
-                                        asyncio.create_task(
+                                        await self.schedule(
+                                            room_id,
+                                            reply_to_event_id,
+                                            sender_id,
+                                            raw_user_message,
                                             self.gpt_vision_cmd(
                                                 room_id,
                                                 reply_to_event_id,
                                                 prompt,
-                                                image_url,
+                                                event_info["content"]["url"],
+                                                image_mimetype,
+                                                event_info["content"]["info"].get(
+                                                    "size"
+                                                ),
                                                 sender_id,
                                                 raw_user_message,
                                                 reply_in_thread=True,
                                                 thread_root_id=thread_root_id,
-                                            )
+                                            ),
+                                            lane=thread_root_id,
                                         )
                                         return
 
@@ -509,6 +795,8 @@ class Bot:
                                 if p:
                                     prompt = p.group(1)
                                     try:
+                                        # queued by the image scheduler, not
+                                        # holding a request scheduler slot
                                         asyncio.create_task(
                                             self.pic(
                                                 room_id,
@@ -546,14 +834,19 @@ class Bot:
 
                                 # normal chatting function
                                 try:
-                                    asyncio.create_task(
+                                    await self.schedule(
+                                        room_id,
+                                        reply_to_event_id,
+                                        sender_id,
+                                        raw_user_message,
                                         self.thread_chat(
                                             room_id,
                                             reply_to_event_id,
                                             sender_id=sender_id,
                                             thread_root_id=thread_root_id,
                                             prompt=content_body,
-                                        )
+                                        ),
+                                        lane=thread_root_id,
                                     )
                                 except Exception as e:
                                     logger.error(e)
@@ -571,14 +864,18 @@ class Bot:
                 if m:
                     prompt = m.group(1)
                     try:
-                        asyncio.create_task(
+                        await self.schedule(
+                            room_id,
+                            reply_to_event_id,
+                            sender_id,
+                            raw_user_message,
                             self.gpt(
                                 room_id,
                                 reply_to_event_id,
                                 prompt,
                                 sender_id,
                                 raw_user_message,
-                            )
+                            ),
                         )
                     except Exception as e:
                         logger.error(e)
@@ -594,14 +891,19 @@ class Bot:
                 if n:
                     prompt = n.group(1)
                     try:
-                        asyncio.create_task(
+                        await self.schedule(
+                            room_id,
+                            reply_to_event_id,
+                            sender_id,
+                            raw_user_message,
                             self.chat(
                                 room_id,
                                 reply_to_event_id,
                                 prompt,
                                 sender_id,
                                 raw_user_message,
-                            )
+                            ),
+                            lane=sender_id,
                         )
                     except Exception as e:
                         logger.error(e)
@@ -688,7 +990,11 @@ class Bot:
                     try:
                         if perm_flags == 1:
                             # have privilege to use langchain
-                            asyncio.create_task(
+                            await self.schedule(
+                                room_id,
+                                reply_to_event_id,
+                                sender_id,
+                                raw_user_message,
                                 self.lc(
                                     room_id,
                                     reply_to_event_id,
@@ -697,7 +1003,7 @@ class Bot:
                                     raw_user_message,
                                     api_url,
                                     api_key,
-                                )
+                                ),
                             )
                         else:
                             # no privilege to use langchain
@@ -1290,6 +1596,8 @@ class Bot:
             if p:
                 prompt = p.group(1)
                 try:
+                    # queued by the image scheduler, not
+                    # holding a request scheduler slot
                     asyncio.create_task(
                         self.pic(
                             room_id,
@@ -1559,69 +1867,150 @@ class Bot:
             logger.info(estr)
 
     # thread chat
+    @timed_command("thread_chat")
     async def thread_chat(
         self, room_id, reply_to_event_id, thread_root_id, prompt, sender_id
     ):
-        try:
-            await self.client.room_typing(room_id, timeout=int(self.timeout) * 1000)
-            content = await self.chatbot.ask_async_v2(
-                prompt=prompt,
-                convo_id=thread_root_id,
-            )
-            await send_room_message(
-                self.client,
-                room_id,
-                reply_message=content,
-                reply_to_event_id=reply_to_event_id,
-                sender_id=sender_id,
-                reply_in_thread=True,
-                thread_root_id=thread_root_id,
-            )
-        except Exception as e:
-            logger.error(e)
-            await send_room_message(
-                self.client,
-                room_id,
-                reply_message=GENERAL_ERROR_MESSAGE,
-                sender_id=sender_id,
-                reply_to_event_id=reply_to_event_id,
-                reply_in_thread=True,
-                thread_root_id=thread_root_id,
-            )
+        # one turn at a time per conversation
+        async with self.lanes.lane(thread_root_id):
+            try:
+                await self.client.room_typing(
+                    room_id, timeout=int(self.timeout) * 1000
+                )
+                if self.stream_reply:
+                    await send_room_message_stream(
+                        self.client,
+                        room_id,
+                        self.chatbot.ask_stream_async(
+                            prompt=prompt,
+                            convo_id=thread_root_id,
+                        ),
+                        reply_to_event_id=reply_to_event_id,
+                        sender_id=sender_id,
+                        reply_in_thread=True,
+                        thread_root_id=thread_root_id,
+                        edit_interval=self.stream_edit_interval,
+                        edit_min_chars=self.stream_edit_min_chars,
+                    )
+                    return
+                content = await self.chatbot.ask_async_v2(
+                    prompt=prompt,
+                    convo_id=thread_root_id,
+                )
+                await send_room_message(
+                    self.client,
+                    room_id,
+                    reply_message=content,
+                    reply_to_event_id=reply_to_event_id,
+                    sender_id=sender_id,
+                    reply_in_thread=True,
+                    thread_root_id=thread_root_id,
+                )
+            except Exception as e:
+                logger.error(e)
+                await send_room_message(
+                    self.client,
+                    room_id,
+                    reply_message=GENERAL_ERROR_MESSAGE,
+                    sender_id=sender_id,
+                    reply_to_event_id=reply_to_event_id,
+                    reply_in_thread=True,
+                    thread_root_id=thread_root_id,
+                )
 
     # !chat command
+    @timed_command("chat")
     async def chat(self, room_id, reply_to_event_id, prompt, sender_id, user_message):
-        try:
-            await self.client.room_typing(room_id, timeout=int(self.timeout) * 1000)
-            content = await self.chatbot.ask_async_v2(
-                prompt=prompt,
-                convo_id=sender_id,
-            )
-            await send_room_message(
-                self.client,
-                room_id,
-                reply_message=content,
-                reply_to_event_id=reply_to_event_id,
-                sender_id=sender_id,
-                user_message=user_message,
-            )
-        except Exception as e:
-            logger.error(e)
-            await self.send_general_error_message(
-                room_id, reply_to_event_id, sender_id, user_message
-            )
+        # one turn at a time per conversation
+        async with self.lanes.lane(sender_id):
+            try:
+                await self.client.room_typing(
+                    room_id, timeout=int(self.timeout) * 1000
+                )
+                if self.stream_reply:
+                    await send_room_message_stream(
+                        self.client,
+                        room_id,
+                        self.chatbot.ask_stream_async(
+                            prompt=prompt,
+                            convo_id=sender_id,
+                        ),
+                        reply_to_event_id=reply_to_event_id,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        edit_interval=self.stream_edit_interval,
+                        edit_min_chars=self.stream_edit_min_chars,
+                    )
+                    return
+                content = await self.chatbot.ask_async_v2(
+                    prompt=prompt,
+                    convo_id=sender_id,
+                )
+                await send_room_message(
+                    self.client,
+                    room_id,
+                    reply_message=content,
+                    reply_to_event_id=reply_to_event_id,
+                    sender_id=sender_id,
+                    user_message=user_message,
+                )
+            except Exception as e:
+                logger.error(e)
+                await self.send_general_error_message(
+                    room_id, reply_to_event_id, sender_id, user_message
+                )
 
     # !gpt command
+    @timed_command("gpt")
     async def gpt(
         self, room_id, reply_to_event_id, prompt, sender_id, user_message
     ) -> None:
         try:
             # sending typing state, seconds to milliseconds
             await self.client.room_typing(room_id, timeout=int(self.timeout) * 1000)
-            responseMessage = await self.chatbot.oneTimeAsk(
-                prompt=prompt,
-            )
 
+            async def ask() -> str:
+                if self.stream_reply:
+                    return await send_room_message_stream(
+                        self.client,
+                        room_id,
+                        self.chatbot.oneTimeAskStream(
+                            prompt=prompt,
+                        ),
+                        reply_to_event_id=reply_to_event_id,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        edit_interval=self.stream_edit_interval,
+                        edit_min_chars=self.stream_edit_min_chars,
+                    )
+                return await self.chatbot.oneTimeAsk(
+                    prompt=prompt,
+                )
+
+            if (
+                "gpt" in self.response_cache_commands
+                and self.temperature <= self.response_cache_max_temperature
+            ):
+                key = make_key(
+                    command="gpt",
+                    prompt=prompt,
+                    api_url=self.chatbot.api_url,
+                    model=self.chatbot.engine,
+                    temperature=self.chatbot.temperature,
+                    top_p=self.chatbot.top_p,
+                    presence_penalty=self.chatbot.presence_penalty,
+                    frequency_penalty=self.chatbot.frequency_penalty,
+                    max_tokens=self.chatbot.max_tokens,
+                )
+                responseMessage, fetched = await self.response_cache.get_or_fetch(
+                    key, ask
+                )
+            else:
+                responseMessage, fetched = await ask(), True
+
+            if fetched and self.stream_reply:
+                # already sent while streaming
+                return
             await send_room_message(
                 self.client,
                 room_id,
@@ -1637,52 +2026,96 @@ class Bot:
             )
 
     # gpt vision
+    @timed_command("gpt_vision_cmd")
     async def gpt_vision_cmd(
         self,
         room_id: str,
         reply_to_event_id: str,
         prompt: str,
-        image_url: str,
+        image_mxc: str,
+        image_mimetype: str,
+        image_size: Optional[int],
         sender_id: str,
         user_message: str,
         reply_in_thread=False,
         thread_root_id=None,
     ) -> None:
-        try:
-            # sending typing state, seconds to milliseconds
-            await self.client.room_typing(room_id, timeout=int(self.timeout) * 1000)
-            responseMessage = await gpt_vision_query(
-                self.gpt_vision_api_endpoint,
-                prompt,
-                image_url,
-                self.gpt_vision_model,
-                self.httpx_client,
-                api_key=self.openai_api_key,
-                timeout=self.timeout,
-            )
-            await send_room_message(
-                self.client,
-                room_id,
-                reply_message=responseMessage.strip(),
-                reply_to_event_id=reply_to_event_id,
-                sender_id=sender_id,
-                user_message=user_message,
-                reply_in_thread=reply_in_thread,
-                thread_root_id=thread_root_id,
-            )
-            if reply_in_thread and thread_root_id:
-                # add gpt vision to thread context
-                self.chatbot.add_to_conversation(
-                    message=responseMessage, role="assistant", convo_id=thread_root_id
+        # replies in a thread are added to the thread context
+        if reply_in_thread and thread_root_id:
+            lane = self.lanes.lane(thread_root_id)
+        else:
+            lane = contextlib.nullcontext()
+        async with lane:
+            try:
+                # downloaded here, within the scheduler limits,
+                # not in the event callback
+                image_url = await self.get_image_url(
+                    image_mxc, image_mimetype, image_size
+                )
+                if image_url is None:
+                    logger.error("Download of image failed")
+                    return
+                # sending typing state, seconds to milliseconds
+                await self.client.room_typing(
+                    room_id, timeout=int(self.timeout) * 1000
                 )
+                if self.stream_reply:
+                    responseMessage = await send_room_message_stream(
+                        self.client,
+                        room_id,
+                        gpt_vision_query_stream(
+                            self.gpt_vision_api_endpoint,
+                            prompt,
+                            image_url,
+                            self.gpt_vision_model,
+                            self.http_pools.get("vision"),
+                            api_key=self.openai_api_key,
+                            timeout=self.timeout,
+                        ),
+                        reply_to_event_id=reply_to_event_id,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        reply_in_thread=reply_in_thread,
+                        thread_root_id=thread_root_id,
+                        edit_interval=self.stream_edit_interval,
+                        edit_min_chars=self.stream_edit_min_chars,
+                    )
+                else:
+                    responseMessage = await gpt_vision_query(
+                        self.gpt_vision_api_endpoint,
+                        prompt,
+                        image_url,
+                        self.gpt_vision_model,
+                        self.http_pools.get("vision"),
+                        api_key=self.openai_api_key,
+                        timeout=self.timeout,
+                    )
+                    await send_room_message(
+                        self.client,
+                        room_id,
+                        reply_message=responseMessage.strip(),
+                        reply_to_event_id=reply_to_event_id,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        reply_in_thread=reply_in_thread,
+                        thread_root_id=thread_root_id,
+                    )
+                if reply_in_thread and thread_root_id:
+                    # add gpt vision to thread context
+                    await self.chatbot.add_to_conversation_async(
+                        message=responseMessage,
+                        role="assistant",
+                        convo_id=thread_root_id,
+                    )
 
-        except Exception as e:
-            logger.error(e)
-            await self.send_general_error_message(
-                room_id, reply_to_event_id, sender_id, user_message
-            )
+            except Exception as e:
+                logger.error(e)
+                await self.send_general_error_message(
+                    room_id, reply_to_event_id, sender_id, user_message
+                )
 
     # !lc command
+    @timed_command("lc")
     async def lc(
         self,
         room_id: str,
@@ -1696,15 +2129,22 @@ class Bot:
         try:
             # sending typing state
             await self.client.room_typing(room_id, timeout=int(self.timeout) * 1000)
-            if flowise_api_key is not None:
-                headers = {"Authorization": f"Bearer {flowise_api_key}"}
-                responseMessage = await flowise_query(
-                    flowise_api_url, prompt, self.httpx_client, headers
+
+            async def ask() -> str:
+                if flowise_api_key is not None:
+                    headers = {"Authorization": f"Bearer {flowise_api_key}"}
+                    return await flowise_query(
+                        flowise_api_url, prompt, self.http_pools.get("flowise"), headers
+                    )
+                return await flowise_query(
+                    flowise_api_url, prompt, self.http_pools.get("flowise")
                 )
+
+            if "lc" in self.response_cache_commands:
+                key = make_key(command="lc", prompt=prompt, api_url=flowise_api_url)
+                responseMessage, _ = await self.response_cache.get_or_fetch(key, ask)
             else:
-                responseMessage = await flowise_query(
-                    flowise_api_url, prompt, self.httpx_client
-                )
+                responseMessage = await ask()
             await send_room_message(
                 self.client,
                 room_id,
@@ -1728,30 +2168,56 @@ class Bot:
         user_message,
         new_command,
     ) -> None:
-        try:
-            if "chat" in new_command:
-                self.chatbot.reset(convo_id=sender_id)
-                content = (
-                    "New conversation created, please use !chat to start chatting!"
+        # wait for running turns before resetting
+        async with self.lanes.lane(sender_id):
+            try:
+                if "chat" in new_command:
+                    self.chatbot.reset(convo_id=sender_id)
+                    content = (
+                        "New conversation created, please use !chat to start chatting!"
+                    )
+                else:
+                    content = (
+                        "Unkown keyword, please use !help to get available commands"
+                    )
+
+                await send_room_message(
+                    self.client,
+                    room_id,
+                    reply_message=content,
+                    reply_to_event_id=reply_to_event_id,
+                    sender_id=sender_id,
+                    user_message=user_message,
+                )
+            except Exception as e:
+                logger.error(e)
+                await self.send_general_error_message(
+                    room_id, reply_to_event_id, sender_id, user_message
                 )
-            else:
-                content = "Unkown keyword, please use !help to get available commands"
 
-            await send_room_message(
-                self.client,
-                room_id,
-                reply_message=content,
-                reply_to_event_id=reply_to_event_id,
-                sender_id=sender_id,
-                user_message=user_message,
-            )
-        except Exception as e:
-            logger.error(e)
-            await self.send_general_error_message(
-                room_id, reply_to_event_id, sender_id, user_message
-            )
+    async def generate_images(
+        self, params: dict, n: int
+    ) -> list[imagegen.GeneratedImage]:
+        """
+        Backend call of the image scheduler, n images of the same params
+        """
+        params = dict(params)
+        prompt = params.pop("prompt")
+        return await imagegen.get_images(
+            self.http_pools.get("image"),
+            self.image_generation_endpoint,
+            prompt,
+            self.image_generation_backend,
+            timeout=self.timeout,
+            api_key=self.openai_api_key,
+            n=n,
+            image_format=self.image_format,
+            pool=self.image_pool,
+            **params,
+        )
 
     # !pic command
+    @timed_command("pic")
     async def pic(
         self,
         room_id,
@@ -1764,36 +2230,57 @@ class Bot:
     ):
         try:
             if self.image_generation_endpoint is not None:
-                await self.client.room_typing(room_id, timeout=int(self.timeout) * 1000)
+                await self.client.room_typing(
+                    room_id, timeout=int(self.timeout) * 1000
+                )
                 # generate image
-                image_path_list = await imagegen.get_images(
-                    self.httpx_client,
-                    self.image_generation_endpoint,
-                    prompt,
-                    self.image_generation_backend,
-                    timeout=self.timeout,
-                    api_key=self.openai_api_key,
-                    output_path=self.base_path / "images",
-                    n=1,
+                job = self.image_scheduler.submit(
+                    prompt=prompt,
                     size=self.image_generation_size,
                     width=self.image_generation_width,
                     height=self.image_generation_height,
                     steps=self.sdwui_steps,
                     sampler_name=self.sdwui_sampler_name,
                     cfg_scale=self.sdwui_cfg_scale,
-                    image_format=self.image_format,
                 )
+                if job is None:
+                    await self.client.room_typing(room_id, typing_state=False)
+                    await send_room_message(
+                        self.client,
+                        room_id,
+                        reply_message=BUSY_MESSAGE,
+                        reply_to_event_id=replay_to_event_id,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        reply_in_thread=reply_in_thread,
+                        thread_root_id=thread_root_id,
+                    )
+                    return
+                position, images = job
+                if position:
+                    await send_room_message(
+                        self.client,
+                        room_id,
+                        reply_message=f"Your image is queued, position {position}",
+                        reply_to_event_id=replay_to_event_id,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        reply_in_thread=reply_in_thread,
+                        thread_root_id=thread_root_id,
+                    )
+                images = await images
                 # send image
-                for image_path in image_path_list:
+                for image in images:
+                    if self.image_save_dir is not None:
+                        await asyncio.to_thread(image.save, self.image_save_dir)
                     await send_room_image(
                         self.client,
                         room_id,
-                        image_path,
+                        image,
                         replay_to_event_id,
                         reply_in_thread=reply_in_thread,
                         thread_root_id=thread_root_id,
                     )
-                    await aiofiles.os.remove(image_path)
                 await self.client.room_typing(room_id, typing_state=False)
             else:
                 await send_room_message(
@@ -1804,6 +2291,19 @@ class Bot:
                     sender_id=sender_id,
                     user_message=user_message,
                 )
+        except ImagePoolFull as e:
+            logger.warning(e)
+            await self.client.room_typing(room_id, typing_state=False)
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message=BUSY_MESSAGE,
+                reply_to_event_id=replay_to_event_id,
+                user_message=user_message,
+                sender_id=sender_id,
+                reply_in_thread=reply_in_thread,
+                thread_root_id=thread_root_id,
+            )
         except Exception as e:
             logger.error(e)
             await send_room_message(
@@ -1813,6 +2313,8 @@ class Bot:
                 reply_to_event_id=replay_to_event_id,
                 user_message=user_message,
                 sender_id=sender_id,
+                reply_in_thread=reply_in_thread,
+                thread_root_id=thread_root_id,
             )
 
     # !help command
@@ -1850,6 +2352,23 @@ class Bot:
             thread_root_id=thread_root_id,
         )
 
+    # run a command through the request scheduler
+    async def schedule(
+        self, room_id, reply_to_event_id, sender_id, user_message, coro, lane=None
+    ) -> None:
+        """
+        lane: conversation of the command, its queued turns start one at a time
+        """
+        if not self.scheduler.submit(room_id, sender_id, coro, lane=lane):
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message=BUSY_MESSAGE,
+                reply_to_event_id=reply_to_event_id,
+                sender_id=sender_id,
+                user_message=user_message,
+            )
+
     # send general error message
     async def send_general_error_message(
         self, room_id, reply_to_event_id, sender_id, user_message
@@ -1885,7 +2404,7 @@ class Bot:
                 )
                 if not isinstance(resp, LoginResponse):
                     logger.error("Login Failed")
-                    await self.httpx_client.aclose()
+                    await self.http_pools.aclose()
                     await self.client.close()
                     sys.exit(1)
                 logger.info("Successfully login via password")
@@ -1917,22 +2436,80 @@ class Bot:
         else:
             logger.info("import_keys success, you can remove import_keys configuration")
 
+    async def start_metrics_server(self) -> None:
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics_host, self.metrics_port)
+            await self.metrics_server.start()
+
+    async def prewarm_connections(self) -> None:
+        """
+        Connect to the configured upstreams before the first request
+        """
+        if not self.http_prewarm:
+            return
+        await self.http_pools.prewarm(
+            {
+                # every endpoint chat requests are routed to
+                "chat": [endpoint.url for endpoint in self.chatbot.router.endpoints],
+                "vision": [self.gpt_vision_api_endpoint],
+                "image": [self.image_generation_endpoint],
+                "homeserver": [self.homeserver],
+            }
+        )
+
     # sync messages in the room
     async def sync_forever(self, timeout=30000, full_state=True) -> None:
         await self.client.sync_forever(timeout=timeout, full_state=full_state)
 
-    # get event from http
+    # get event from the event cache, or from http
     async def get_event(self, room_id: str, event_id: str) -> dict:
+        if self.event_cache_size:
+            event = self.event_cache.get(room_id, event_id)
+            if event is not None:
+                return event
         method, path = Api.room_get_event(self.access_token, room_id, event_id)
         url = self.homeserver + path
         if method == "GET":
-            resp = await self.httpx_client.get(url)
-            return resp.json()
+            resp = await self.http_pools.get("homeserver").get(url)
         elif method == "POST":
-            resp = await self.httpx_client.post(url)
-            return resp.json()
+            resp = await self.http_pools.get("homeserver").post(url)
+        event = resp.json()
+        if self.event_cache_size and resp.is_success:
+            self.event_cache.put(room_id, event)
+        return event
 
     # download mxc
     async def download_mxc(self, mxc: str, filename: Optional[str] = None):
         response = await self.client.download(mxc, filename)
         return response
+
+    # data url of an image, from the media cache or downloaded
+    async def get_image_url(
+        self, mxc: str, mimetype: str, size: Optional[int] = None
+    ) -> Optional[bytearray]:
+        if size is not None and size > self.vision_max_image_bytes:
+            logger.warning(f"Image {mxc} of {size} bytes is too large for vision")
+            return None
+
+        async def fetch() -> Optional[tuple[bytes, str]]:
+            resp = await self.download_mxc(mxc)
+            if isinstance(resp, DownloadError):
+                return None
+            if len(resp.body) > self.vision_max_image_bytes:
+                logger.warning(
+                    f"Image {mxc} of {len(resp.body)} bytes is too large for vision"
+                )
+                return None
+            if self.image_preprocessor is not None:
+                return await self.image_preprocessor.process(resp.body, mimetype)
+            return resp.body, mimetype
+
+        if not self.media_cache_bytes:
+            media = await fetch()
+            if media is None:
+                return None
+            return encode_data_url(*media)
+        entry = await self.media_cache.get_or_fetch(mxc, fetch)
+        if entry is None:
+            return None
+        return self.media_cache.data_url(entry)
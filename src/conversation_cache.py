@@ -0,0 +1,205 @@
+"""
+In memory LRU cache for conversations stored in context.db
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+# rough per message overhead of the dict and its keys
+MESSAGE_OVERHEAD = 64
+
+
+def message_size(message: dict) -> int:
+    return MESSAGE_OVERHEAD + sum(len(value) for value in message.values() if value)
+
+
+class Conversation:
+    """
+    Messages of one conversation with their token counts
+    """
+
+    def __init__(
+        self, messages: list[dict], tokens: list[int], seqs: list[int] = None
+    ) -> None:
+        self.messages = messages
+        self.tokens = tokens
+        # position of each message in the messages table
+        self.seqs = seqs if seqs is not None else list(range(len(messages)))
+        self.total_tokens = sum(tokens)
+        self.size = sum(message_size(message) for message in messages)
+        # changed since last saved to context.db
+        self.dirty = False
+
+    def append(self, message: dict, num_tokens: int) -> int:
+        """
+        Append a message, return its seq
+        """
+        seq = self.seqs[-1] + 1 if self.seqs else 0
+        self.messages.append(message)
+        self.tokens.append(num_tokens)
+        self.seqs.append(seq)
+        self.total_tokens += num_tokens
+        self.size += message_size(message)
+        self.dirty = True
+        return seq
+
+    def remove(self, start: int, end: int) -> int:
+        """
+        Remove messages[start:end], return the number of tokens removed
+        """
+        removed = sum(self.tokens[start:end])
+        self.size -= sum(message_size(message) for message in self.messages[start:end])
+        del self.messages[start:end]
+        del self.tokens[start:end]
+        del self.seqs[start:end]
+        self.total_tokens -= removed
+        self.dirty = True
+        return removed
+
+
+class ConversationCache:
+    """
+    Keep recently used conversations in memory, load the others on demand.
+
+    max_conversations: max number of conversations in memory, 0 for unlimited
+    max_bytes: approximate memory budget of cached messages, 0 for unlimited
+    loader: load a conversation from context.db, return None if it doesn't exist
+    writer: persist a dirty conversation before it is evicted
+    known: ids of the conversations in context.db, only those are loaded
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Optional[Conversation]],
+        writer: Callable[[str, Conversation], None],
+        max_conversations: int = 0,
+        max_bytes: int = 0,
+        known: Optional[Iterable[str]] = None,
+    ) -> None:
+        self.loader = loader
+        self.writer = writer
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+
+        self._entries: OrderedDict[str, Conversation] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._pinned: set[str] = set()
+        # every conversation in memory or in context.db
+        self._known: set[str] = set(known or ())
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, convo_id: str) -> bool:
+        # doesn't load the conversation
+        return convo_id in self._known
+
+    def __getitem__(self, convo_id: str) -> Conversation:
+        conversation = self.get(convo_id)
+        if conversation is None:
+            raise KeyError(convo_id)
+        return conversation
+
+    def __setitem__(self, convo_id: str, conversation: Conversation) -> None:
+        if convo_id in self._entries:
+            self.bytes -= self._sizes[convo_id]
+        self._entries[convo_id] = conversation
+        self._entries.move_to_end(convo_id)
+        self._known.add(convo_id)
+        self._sizes[convo_id] = conversation.size
+        self.bytes += conversation.size
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, convo_id: str) -> Optional[Conversation]:
+        conversation = self._entries.get(convo_id)
+        if conversation is not None:
+            self.hits += 1
+            self._entries.move_to_end(convo_id)
+            return conversation
+        if convo_id not in self._known:
+            return None
+
+        self.misses += 1
+        conversation = self.loader(convo_id)
+        if conversation is not None:
+            self[convo_id] = conversation
+        return conversation
+
+    async def get_async(self, convo_id: str) -> Optional[Conversation]:
+        """
+        get, with the conversation loaded in a worker thread
+        instead of on the event loop
+        """
+        conversation = self._entries.get(convo_id)
+        if conversation is not None or convo_id not in self._known:
+            return self.get(convo_id)
+
+        self.misses += 1
+        conversation = await asyncio.to_thread(self.loader, convo_id)
+        if convo_id in self._entries:
+            # loaded or reset by another task meanwhile
+            return self._entries[convo_id]
+        if conversation is not None:
+            self[convo_id] = conversation
+        return conversation
+
+    def pin(self, convo_id: str, conversation: Conversation) -> None:
+        """
+        Keep a conversation in memory regardless of the limits
+        """
+        self._pinned.add(convo_id)
+        self[convo_id] = conversation
+
+    def touch(self, convo_id: str) -> None:
+        """
+        Account for a conversation that changed size
+        """
+        conversation = self._entries.get(convo_id)
+        if conversation is None:
+            return
+        self.bytes += conversation.size - self._sizes[convo_id]
+        self._sizes[convo_id] = conversation.size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._over_budget():
+            for convo_id in self._entries:
+                if convo_id not in self._pinned:
+                    break
+            else:
+                # only pinned conversations left
+                return
+            conversation = self._entries.pop(convo_id)
+            self.bytes -= self._sizes.pop(convo_id)
+            self.evictions += 1
+            if conversation.dirty:
+                self.writer(convo_id, conversation)
+
+    def _over_budget(self) -> bool:
+        if self.max_conversations and len(self._entries) > self.max_conversations:
+            return True
+        if self.max_bytes and self.bytes > self.max_bytes:
+            return True
+        return False
+
+    def flush(self) -> None:
+        """
+        Persist every dirty conversation
+        """
+        for convo_id, conversation in list(self._entries.items()):
+            if conversation.dirty:
+                self.writer(convo_id, conversation)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "conversations": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,162 @@
+"""
+Write-behind sqlite persistence, writes are group committed on a dedicated thread
+"""
+from collections import Counter
+import queue
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from log import getlogger
+from metrics import DB_WRITE_SECONDS
+
+logger = getlogger()
+
+SYNCHRONOUS_LEVELS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+
+class DBWriter:
+    """
+    db_path: sqlite database path
+    flush_interval: seconds to wait for more writes before committing a batch
+    synchronous: sqlite synchronous pragma, OFF NORMAL FULL or EXTRA
+    max_batch: max number of statements in one transaction
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        flush_interval: float = 0.05,
+        synchronous: str = "NORMAL",
+        max_batch: int = 1000,
+    ) -> None:
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"synchronous should be one of {SYNCHRONOUS_LEVELS}")
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.max_batch = max_batch
+
+        self._queue: queue.Queue = queue.Queue()
+        # convo_id -> number of queued statements not committed yet
+        self._pending: Counter = Counter()
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.statements = 0
+        self.failed = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name="context-db-writer", daemon=True
+        )
+        self._thread.start()
+
+    def execute(self, key: str, sql: str, params: tuple = ()) -> None:
+        """
+        Queue a statement, key is used to check for pending writes
+        """
+        self.executegroup(key, [(sql, [params])])
+
+    def executemany(self, key: str, sql: str, seq_of_params: list[tuple]) -> None:
+        self.executegroup(key, [(sql, seq_of_params)])
+
+    def executegroup(self, key: str, statements: list[tuple[str, list[tuple]]]) -> None:
+        """
+        Queue statements, as sql and seq_of_params, committed together
+        or rolled back together
+        """
+        statements = [(sql, seq) for sql, seq in statements if seq]
+        if not statements:
+            return
+        with self._lock:
+            self._pending[key] += 1
+        self._queue.put((key, statements))
+
+    def is_pending(self, key: str) -> bool:
+        with self._lock:
+            return self._pending[key] > 0
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(self._pending.values())
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until every queued write is committed
+        """
+        if not self._thread.is_alive():
+            return self.pending == 0
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        """
+        Commit pending writes and stop the writer thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self) -> None:
+        # transactions and savepoints are managed below
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # stop gathering on close or flush request
+            while len(batch) < self.max_batch and isinstance(batch[-1], tuple):
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(self._queue.get(timeout=timeout))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            waiters = [item for item in batch if isinstance(item, threading.Event)]
+            writes = [item for item in batch if isinstance(item, tuple)]
+            stopping = batch[-1] is None
+            start = time.perf_counter()
+            try:
+                if writes:
+                    conn.execute("BEGIN")
+                    for key, statements in writes:
+                        self._write(conn, key, statements)
+                    conn.execute("COMMIT")
+                    DB_WRITE_SECONDS.observe(time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"context db commit failed: {e}", exc_info=True)
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            with self._lock:
+                for key, _ in writes:
+                    self._pending[key] -= 1
+                    if self._pending[key] <= 0:
+                        del self._pending[key]
+            if writes:
+                self.batches += 1
+                self.statements += len(writes)
+            for waiter in waiters:
+                waiter.set()
+        conn.close()
+
+    def _write(
+        self, conn: sqlite3.Connection, key: str, statements: list[tuple[str, list]]
+    ) -> None:
+        # a failed group is rolled back alone, the rest of the batch commits
+        conn.execute("SAVEPOINT write")
+        try:
+            for sql, seq_of_params in statements:
+                conn.executemany(sql, seq_of_params)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"context db write of {key} failed: {e}", exc_info=True)
+            conn.execute("ROLLBACK TO write")
+        conn.execute("RELEASE write")
@@ -0,0 +1,177 @@
+"""
+Route chat completions over several OpenAI compatible endpoints,
+with passive health tracking and a circuit breaker per endpoint
+"""
+import random
+import time
+from typing import Optional
+
+from log import getlogger
+from metrics import ENDPOINT_AVAILABLE, ENDPOINT_LATENCY_SECONDS
+
+logger = getlogger()
+
+# smoothing factor of the latency moving average
+LATENCY_ALPHA = 0.3
+
+
+class Endpoint:
+    """
+    url: chat completions url
+    api_key: api key of this endpoint
+    api_keys: pool of api keys used in turn, instead of api_key
+    model: model used on this endpoint, None for the Chatbot engine
+    weight: relative share of the traffic at equal latency
+    """
+
+    def __init__(
+        self,
+        url: str,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None,
+        weight: float = 1.0,
+        name: Optional[str] = None,
+        api_keys: Optional[list[str]] = None,
+    ) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.api_keys = api_keys
+        self.model = model
+        self.weight = weight
+        self.name = name or url
+
+        # moving average of the time to response headers
+        self.latency: Optional[float] = None
+        self.consecutive_failures = 0
+        # circuit breaker: closed, open or half_open
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class EndpointRouter:
+    """
+    failure_threshold: consecutive failures that open the circuit of an endpoint
+    reset_timeout: seconds before an open circuit lets a probe request through
+
+    An endpoint with an open circuit gets no traffic until reset_timeout passed,
+    then a single request probes it, success closes the circuit again.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("at least one endpoint is required")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    def _available(self, endpoint: Endpoint, now: float) -> bool:
+        if endpoint.state == "closed":
+            return True
+        if endpoint.state == "open" and now - endpoint.opened_at >= self.reset_timeout:
+            endpoint.state = "half_open"
+            endpoint.probing = False
+        # one probe request at a time
+        return endpoint.state == "half_open" and not endpoint.probing
+
+    def _score(self, endpoint: Endpoint, default_latency: float) -> float:
+        latency = endpoint.latency if endpoint.latency is not None else default_latency
+        return endpoint.weight / max(latency, 0.001)
+
+    def candidates(self, exclude: tuple = ()) -> list[Endpoint]:
+        """
+        Endpoints to try in order: a healthy one picked at random, weighted by
+        weight / latency, then the other healthy ones from best to worst,
+        then the ejected ones in case everything else fails
+        """
+        now = time.monotonic()
+        endpoints = [e for e in self.endpoints if e not in exclude]
+        healthy = [e for e in endpoints if self._available(e, now)]
+        ejected = sorted(
+            (e for e in endpoints if e not in healthy), key=lambda e: e.opened_at
+        )
+        if not healthy:
+            return ejected
+
+        # endpoints without samples are scored like an average one
+        known = [e.latency for e in healthy if e.latency is not None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        scores = [self._score(e, default_latency) for e in healthy]
+        first = random.choices(healthy, weights=scores)[0]
+        rest = sorted(
+            (e for e in healthy if e is not first),
+            key=lambda e: self._score(e, default_latency),
+            reverse=True,
+        )
+        return [first] + rest + ejected
+
+    def reorder(self, endpoints: list[Endpoint]) -> list[Endpoint]:
+        """
+        Endpoints in the same order, except those ejected since the order
+        was picked, which move to the back
+        """
+        now = time.monotonic()
+        healthy = [e for e in endpoints if self._available(e, now)]
+        return healthy + [e for e in endpoints if e not in healthy]
+
+    def start(self, endpoint: Endpoint) -> None:
+        endpoint.requests += 1
+        if endpoint.state == "half_open":
+            endpoint.probing = True
+
+    def record_success(self, endpoint: Endpoint, latency: float) -> None:
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += LATENCY_ALPHA * (latency - endpoint.latency)
+        endpoint.consecutive_failures = 0
+        if endpoint.state != "closed":
+            logger.info(f"Endpoint {endpoint.name} recovered")
+        endpoint.state = "closed"
+        endpoint.probing = False
+
+    def record_failure(self, endpoint: Endpoint, error: str = "") -> None:
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        endpoint.probing = False
+        if endpoint.state == "half_open" or (
+            endpoint.state == "closed"
+            and endpoint.consecutive_failures >= self.failure_threshold
+        ):
+            logger.warning(
+                f"Endpoint {endpoint.name} ejected for {self.reset_timeout}s "
+                f"after {endpoint.consecutive_failures} failures: {error}"
+            )
+            endpoint.state = "open"
+            endpoint.opened_at = time.monotonic()
+
+    def cancel(self, endpoint: Endpoint) -> None:
+        endpoint.requests -= 1
+        endpoint.probing = False
+
+    def stats(self) -> dict[str, dict]:
+        return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+    def collect_metrics(self) -> None:
+        for endpoint in self.endpoints:
+            ENDPOINT_AVAILABLE.set(
+                1 if endpoint.state == "closed" else 0, endpoint=endpoint.name
+            )
+            if endpoint.latency is not None:
+                ENDPOINT_LATENCY_SECONDS.set(endpoint.latency, endpoint=endpoint.name)
@@ -0,0 +1,59 @@
+"""
+Recent room events kept from the sync stream, so replies and threads
+don't fetch the event they point to from the homeserver
+"""
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import EVENT_CACHE_LOOKUPS
+
+
+class EventCache:
+    """
+    max_events: events kept per room, the oldest are dropped first
+    max_rooms: rooms kept, the least recently active are dropped first
+    """
+
+    def __init__(self, max_events: int = 500, max_rooms: int = 1000) -> None:
+        self.max_events = max_events
+        self.max_rooms = max_rooms
+        # room_id -> event_id -> event
+        self._rooms: OrderedDict[str, OrderedDict[str, dict]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, room_id: str, event: dict) -> None:
+        event_id = event.get("event_id")
+        if not event_id:
+            return
+        events = self._rooms.get(room_id)
+        if events is None:
+            events = self._rooms[room_id] = OrderedDict()
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room_id)
+        events[event_id] = event
+        events.move_to_end(event_id)
+        while len(events) > self.max_events:
+            events.popitem(last=False)
+
+    def get(self, room_id: str, event_id: str) -> Optional[dict]:
+        events = self._rooms.get(room_id)
+        event = events.get(event_id) if events is not None else None
+        if event is None:
+            self.misses += 1
+            EVENT_CACHE_LOOKUPS.inc(result="miss")
+        else:
+            self.hits += 1
+            EVENT_CACHE_LOOKUPS.inc(result="hit")
+        return event
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "events": sum(len(events) for events in self._rooms.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
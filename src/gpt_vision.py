@@ -1,10 +1,34 @@
+from typing import AsyncGenerator, Union
+
 import httpx
 
+from gptbot import iter_stream_deltas
+from vision_payload import VisionPayload
+
+
+def build_request(
+    prompt: str,
+    image_url: Union[str, bytes, bytearray],
+    model: str,
+    stream: bool = False,
+    **kwargs,
+) -> tuple[dict, VisionPayload]:
+    """
+    image_url: an image url, or a data url, preferably from encode_data_url
+    """
+    extra = {"stream": True} if stream else {}
+    payload = VisionPayload(model, prompt, image_url, **extra)
+    headers = {
+        **payload.headers,
+        "Authorization": f"Bearer {kwargs.get('api_key', '')}",
+    }
+    return headers, payload
+
 
 async def gpt_vision_query(
     api_url: str,
     prompt: str,
-    image_url: str,
+    image_url: Union[str, bytes, bytearray],
     model: str,
     session: httpx.AsyncClient,
     **kwargs,
@@ -12,26 +36,10 @@ async def gpt_vision_query(
     """
     model: gpt-4-vision-preview or llava
     """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {kwargs.get('api_key', '')}",
-    }
-
-    payload = {
-        "model": model,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": image_url}},
-                ],
-            }
-        ],
-    }
+    headers, payload = build_request(prompt, image_url, model, **kwargs)
 
     response = await session.post(
-        api_url, headers=headers, json=payload, timeout=kwargs.get("timeout", "120")
+        api_url, headers=headers, content=payload, timeout=kwargs.get("timeout", 120)
     )
     if response.status_code == 200:
         resp = response.json()["choices"][0]
@@ -40,6 +48,31 @@ async def gpt_vision_query(
         response.raise_for_status()
 
 
+async def gpt_vision_query_stream(
+    api_url: str,
+    prompt: str,
+    image_url: Union[str, bytes, bytearray],
+    model: str,
+    session: httpx.AsyncClient,
+    **kwargs,
+) -> AsyncGenerator[str, None]:
+    """
+    Like gpt_vision_query, yield the reply as it is generated
+    """
+    headers, payload = build_request(prompt, image_url, model, stream=True, **kwargs)
+
+    async with session.stream(
+        "POST",
+        api_url,
+        headers=headers,
+        content=payload,
+        timeout=kwargs.get("timeout", 120),
+    ) as response:
+        async for delta in iter_stream_deltas(response):
+            if "content" in delta and delta["content"]:
+                yield delta["content"]
+
+
 async def test():
     async with httpx.AsyncClient() as session:
         api_url = "http://127.0.0.1:12345/v1/chat/completions"
@@ -2,19 +2,134 @@
 Code derived from https://github.com/acheong08/ChatGPT/blob/main/src/revChatGPT/V3.py
 A simple wrapper for the official ChatGPT API
 """
+import asyncio
 import sqlite3
 import json
-from typing import AsyncGenerator
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+import threading
+import time
+from typing import AsyncGenerator, Optional
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 import httpx
 import tiktoken
 
+from conversation_cache import Conversation, ConversationCache
+from db_writer import DBWriter
+from endpoint_router import Endpoint, EndpointRouter
+from hedging import HedgePolicy
+from rate_limiter import RateLimiter, RateLimitExceeded, parse_retry_after
+from tokenizer import count_tokens_async, load_encoding
+from log import getlogger
+from metrics import HEDGED_REQUESTS, TOKENS
+
+logger = getlogger()
+
 
 ENGINES = ["gpt-3.5-turbo", "gpt-4", "gpt-4-32k", "gpt-4-turbo"]
 
+INSERT_MESSAGE_SQL = "INSERT INTO messages (convo_id, seq, role, content, tokens) VALUES (?, ?, ?, ?, ?)"  # noqa: E501
+
+# statuses worth retrying on another endpoint
+FAILOVER_STATUS = [408, 429, 500, 502, 503, 504]
+
 # GPT O-series models
 GPT_O_MODEL = ["o1-preview", "o1-mini", "o1", "o1-pro", "o3-mini", "o3", "o4-mini"]
 
+# longest retry-after honored between retries
+MAX_RETRY_AFTER = 30.0
+
+
+class APIError(Exception):
+    """
+    Error response of a chat completions endpoint
+    """
+
+    def __init__(
+        self, status_code: int, message: str, retry_after: Optional[float] = None
+    ) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @classmethod
+    async def from_response(cls, response: httpx.Response) -> "APIError":
+        await response.aread()
+        return cls(
+            response.status_code,
+            f"{response.status_code} {response.reason_phrase} {response.text}",
+            parse_retry_after(response.headers),
+        )
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    Connection errors, timeouts and 408, 429 and 5xx responses,
+    a 400 fails the same way every time
+    """
+    if isinstance(e, APIError):
+        return e.status_code in FAILOVER_STATUS
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def wait_retryable(retry_state) -> float:
+    """
+    tenacity wait: a 429 is paced by the rate limiter, other errors
+    wait for their retry-after or back off exponentially
+    """
+    e = retry_state.outcome.exception()
+    if isinstance(e, APIError):
+        if e.status_code == 429:
+            return 0
+        if e.retry_after is not None:
+            return min(e.retry_after, MAX_RETRY_AFTER)
+    return wait_random_exponential(min=1, max=5)(retry_state)
+
+
+def find_truncate_index(token_counts: list[int], excess: int) -> tuple[int, int]:
+    """
+    Find where to cut a conversation so that at least `excess` tokens are dropped,
+    always keeping the first message.
+    Returns the exclusive end index of messages to remove starting from index 1
+    and the number of tokens removed.
+    """
+    cut = 1
+    removed = 0
+    while removed < excess and cut < len(token_counts):
+        removed += token_counts[cut]
+        cut += 1
+    return cut, removed
+
+
+async def iter_stream_deltas(response: httpx.Response) -> AsyncGenerator[dict, None]:
+    """
+    Parse a chat completions SSE response, yield the delta of the first choice
+    """
+    if response.status_code != 200:
+        raise await APIError.from_response(response)
+
+    async for line in response.aiter_lines():
+        line = line.strip()
+        if not line:
+            continue
+        # Remove "data: "
+        line = line[6:]
+        if line == "[DONE]":
+            break
+        resp: dict = json.loads(line)
+        if "error" in resp:
+            raise Exception(f"{resp['error']}")
+        choices = resp.get("choices")
+        if not choices:
+            continue
+        delta: dict[str, str] = choices[0].get("delta")
+        if not delta:
+            continue
+        yield delta
+
 
 class Chatbot:
     """
@@ -37,6 +152,21 @@ class Chatbot:
         truncate_limit: int = None,
         system_prompt: str = None,
         db_path: str = "context.db",
+        conversation_cache_size: int = 1000,
+        conversation_cache_bytes: int = 0,
+        db_flush_interval: float = 0.05,
+        db_synchronous: str = "NORMAL",
+        tokenizer_cache_dir: str = None,
+        tokenize_offload_chars: int = 4096,
+        endpoints: Optional[list[dict]] = None,
+        endpoint_failure_threshold: int = 3,
+        endpoint_reset_timeout: float = 30.0,
+        endpoint_failover_timeout: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        hedge_budget: float = 0.05,
+        api_keys: Optional[list[str]] = None,
+        rate_limit_max_wait: float = 60.0,
+        rate_limit_release_interval: float = 0.1,
     ) -> None:
         """
         Initialize Chatbot with API key (from https://platform.openai.com/account/api-keys)
@@ -77,108 +207,516 @@ class Chatbot:
 
         self.aclient = aclient
 
+        # keys used in turn by endpoints without their own key
+        self.api_keys: list[str] = api_keys or [self.api_key]
+        # api_url alone is a pool of one endpoint
+        self.router = EndpointRouter(
+            [Endpoint(**endpoint) for endpoint in endpoints]
+            if endpoints
+            else [Endpoint(self.api_url)],
+            failure_threshold=endpoint_failure_threshold,
+            reset_timeout=endpoint_reset_timeout,
+        )
+        # seconds to wait for response headers before trying the next endpoint
+        self.endpoint_failover_timeout = endpoint_failover_timeout
+        self.rate_limiter = RateLimiter(
+            max_wait=rate_limit_max_wait, release_interval=rate_limit_release_interval
+        )
+        # duplicate slow one-shot requests, off unless hedge_percentile is set
+        self.hedging: Optional[HedgePolicy] = (
+            HedgePolicy(percentile=hedge_percentile, budget=hedge_budget)
+            if hedge_percentile
+            else None
+        )
+
+        # local directory with tiktoken BPE files, for offline deployments
+        self.tokenizer_cache_dir = tokenizer_cache_dir
+        # messages longer than this are tokenized in a worker thread
+        self.tokenize_offload_chars = tokenize_offload_chars
+
         self.db_path = db_path
 
-        self.conn = sqlite3.connect(self.db_path)
+        # conversations are also loaded from worker threads, one at a time
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        self._load_lock = threading.Lock()
+
+        # resolve the tokenizer once instead of on every token count
+        self.encoding = self._get_encoding()
 
         self._create_tables()
 
-        self.conversation = self._load_conversation()
+        # writes are queued and group committed on a writer thread
+        self.writer = DBWriter(
+            self.db_path,
+            flush_interval=db_flush_interval,
+            synchronous=db_synchronous,
+        )
+
+        # conversations are loaded from context.db on demand
+        self.conversation = ConversationCache(
+            loader=self._load_conversation,
+            writer=self._save_conversation,
+            max_conversations=conversation_cache_size,
+            max_bytes=conversation_cache_bytes,
+            known=[
+                row[0]
+                for row in self.conn.execute("SELECT DISTINCT convo_id FROM messages")
+            ],
+        )
+        self.conversation.pin(
+            "default",
+            self._new_conversation(
+                [
+                    {
+                        "role": "system",
+                        "content": self.system_prompt,
+                    },
+                ]
+            ),
+        )
 
         if self.get_token_count("default") > self.max_tokens:
             raise Exception("System prompt is too long")
 
     def _create_tables(self) -> None:
+        self.conn.execute("PRAGMA journal_mode=WAL")
         self.conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS conversations(
+            CREATE TABLE IF NOT EXISTS messages(
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    convo_id TEXT UNIQUE,
-                    messages TEXT
+                    convo_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT,
+                    content TEXT,
+                    tokens INTEGER NOT NULL
             )
         """
         )
-
-    def _load_conversation(self) -> dict[str, list[dict]]:
-        conversations: dict[str, list[dict]] = {
-            "default": [
-                {
-                    "role": "system",
-                    "content": self.system_prompt,
-                },
-            ],
-        }
-        self.cursor.execute("SELECT convo_id, messages FROM conversations")
-        for convo_id, messages in self.cursor.fetchall():
-            conversations[convo_id] = json.loads(messages)
-        return conversations
-
-    def _save_conversation(self, convo_id) -> None:
         self.conn.execute(
-            "INSERT OR REPLACE INTO conversations (convo_id, messages) VALUES (?, ?)",
-            (convo_id, json.dumps(self.conversation[convo_id])),
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_convo_seq
+            ON messages(convo_id, seq)
+        """
         )
+        self._migrate_conversations()
         self.conn.commit()
 
+    def _migrate_conversations(self) -> None:
+        """
+        Move conversations stored as json blobs by older versions into messages
+        """
+        self.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'conversations'"  # noqa: E501
+        )
+        if self.cursor.fetchone() is None:
+            return
+        columns = [
+            row[1] for row in self.conn.execute("PRAGMA table_info(conversations)")
+        ]
+        if "tokens" in columns:
+            self.cursor.execute("SELECT convo_id, messages, tokens FROM conversations")
+        else:
+            self.cursor.execute("SELECT convo_id, messages, NULL FROM conversations")
+        count = 0
+        for convo_id, messages, tokens in self.cursor:
+            messages = json.loads(messages)
+            token_counts = json.loads(tokens) if tokens else None
+            if token_counts is None or len(token_counts) != len(messages):
+                conversation = self._new_conversation(messages)
+            else:
+                conversation = Conversation(messages, token_counts)
+            self.conn.executemany(
+                INSERT_MESSAGE_SQL, self._message_rows(convo_id, conversation, 0)
+            )
+            count += 1
+        self.conn.execute("DROP TABLE conversations")
+        logger.info(f"Migrated {count} conversations to the messages table")
+
+    def _new_conversation(self, messages: list[dict]) -> Conversation:
+        return Conversation(
+            messages, [self._count_message_tokens(message) for message in messages]
+        )
+
+    def _load_conversation(self, convo_id: str) -> Optional[Conversation]:
+        if self.writer.is_pending(convo_id):
+            # evicted before its writes were committed
+            self.writer.flush()
+        with self._load_lock:
+            self.cursor.execute(
+                "SELECT seq, role, content, tokens FROM messages WHERE convo_id = ? ORDER BY seq",  # noqa: E501
+                (convo_id,),
+            )
+            rows = self.cursor.fetchall()
+        if not rows:
+            return None
+        return Conversation(
+            [{"role": role, "content": content} for _, role, content, _ in rows],
+            [row[3] for row in rows],
+            [row[0] for row in rows],
+        )
+
+    def _message_rows(
+        self, convo_id: str, conversation: Conversation, start: int
+    ) -> list[tuple]:
+        return [
+            (
+                convo_id,
+                conversation.seqs[i],
+                conversation.messages[i].get("role"),
+                conversation.messages[i].get("content"),
+                conversation.tokens[i],
+            )
+            for i in range(start, len(conversation.messages))
+        ]
+
+    def _save_conversation(
+        self, convo_id: str, conversation: Optional[Conversation] = None
+    ) -> None:
+        """
+        Rewrite all messages of a conversation
+        """
+        if conversation is None:
+            conversation = self.conversation[convo_id]
+        # the old messages are only deleted if the new ones are written
+        self.writer.executegroup(
+            convo_id,
+            [
+                ("DELETE FROM messages WHERE convo_id = ?", [(convo_id,)]),
+                (INSERT_MESSAGE_SQL, self._message_rows(convo_id, conversation, 0)),
+            ],
+        )
+        conversation.dirty = False
+        self.conversation.touch(convo_id)
+
     def add_to_conversation(
         self,
         message: str,
         role: str,
         convo_id: str = "default",
-    ) -> None:
+    ) -> int:
         """
-        Add a message to the conversation
+        Add a message to the conversation, return its token count
         """
-        self.conversation[convo_id].append({"role": role, "content": message})
-        self._save_conversation(convo_id)
+        new_message = {"role": role, "content": message}
+        num_tokens = self._count_message_tokens(new_message)
+        self._append_message(convo_id, new_message, num_tokens)
+        return num_tokens
+
+    async def add_to_conversation_async(
+        self,
+        message: str,
+        role: str,
+        convo_id: str = "default",
+    ) -> int:
+        """
+        Add a message to the conversation, long messages are tokenized off the loop.
+        Return its token count
+        """
+        await self.conversation.get_async(convo_id)
+        new_message = {"role": role, "content": message}
+        num_tokens = await self._count_message_tokens_async(new_message)
+        self._append_message(convo_id, new_message, num_tokens)
+        return num_tokens
+
+    def _append_message(self, convo_id: str, message: dict, num_tokens: int) -> None:
+        conversation = self.conversation[convo_id]
+        conversation.append(message, num_tokens)
+        self.writer.executemany(
+            convo_id,
+            INSERT_MESSAGE_SQL,
+            self._message_rows(convo_id, conversation, len(conversation.messages) - 1),
+        )
+        conversation.dirty = False
+        self.conversation.touch(convo_id)
 
     def __truncate_conversation(self, convo_id: str = "default") -> None:
         """
         Truncate the conversation
         """
-        while True:
-            if (
-                self.get_token_count(convo_id) > self.truncate_limit
-                and len(self.conversation[convo_id]) > 1
-            ):
-                # Don't remove the first message
-                self.conversation[convo_id].pop(1)
-            else:
-                break
-        self._save_conversation(convo_id)
+        conversation = self.conversation[convo_id]
+        cut, _ = find_truncate_index(
+            conversation.tokens,
+            self.get_token_count(convo_id) - self.truncate_limit,
+        )
+        if cut == 1:
+            # nothing removed, skip touching the database
+            return
+        first_seq, last_seq = conversation.seqs[1], conversation.seqs[cut - 1]
+        conversation.remove(1, cut)
+        self.writer.execute(
+            convo_id,
+            "DELETE FROM messages WHERE convo_id = ? AND seq BETWEEN ? AND ?",
+            (convo_id, first_seq, last_seq),
+        )
+        conversation.dirty = False
+        self.conversation.touch(convo_id)
 
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def get_token_count(self, convo_id: str = "default") -> int:
+    def _get_encoding(self) -> tiktoken.Encoding:
         """
-        Get token count
+        Resolve the tiktoken encoding for the current engine
         """
         _engine = self.engine
         if self.engine not in ENGINES:
             # use gpt-3.5-turbo to caculate token
             _engine = "gpt-3.5-turbo"
-        tiktoken.model.MODEL_TO_ENCODING["gpt-4"] = "cl100k_base"
-
-        encoding = tiktoken.encoding_for_model(_engine)
-
-        num_tokens = 0
-        for message in self.conversation[convo_id]:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 5
-            for key, value in message.items():
-                if value:
-                    num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += 5  # role is always required and always 1 token
-        num_tokens += 5  # every reply is primed with <im_start>assistant
+
+        return load_encoding(_engine, self.tokenizer_cache_dir)
+
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    def _count_message_tokens(self, message: dict) -> int:
+        """
+        Get token count of a single message
+        """
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 5
+        for key, value in message.items():
+            if value:
+                num_tokens += len(self.encoding.encode(value))
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += 5  # role is always required and always 1 token
+        return num_tokens
+
+    async def _count_message_tokens_async(self, message: dict) -> int:
+        """
+        Get token count of a single message, long texts are encoded off the loop
+        """
+        num_tokens = 5
+        for key, value in message.items():
+            if value:
+                num_tokens += await count_tokens_async(
+                    self.encoding, value, self.tokenize_offload_chars
+                )
+            if key == "name":
+                num_tokens += 5
         return num_tokens
 
+    async def _count_usage(self, prompt: str, completion: str) -> dict:
+        """
+        Count tokens locally for upstreams that don't return usage
+        """
+        return {
+            "prompt_tokens": await count_tokens_async(
+                self.encoding, prompt, self.tokenize_offload_chars
+            ),
+            "completion_tokens": await count_tokens_async(
+                self.encoding, completion, self.tokenize_offload_chars
+            ),
+        }
+
+    def _observe_usage(self, model: str, usage: dict) -> None:
+        TOKENS.observe(usage.get("prompt_tokens", 0), kind="prompt", model=model)
+        TOKENS.observe(
+            usage.get("completion_tokens", 0), kind="completion", model=model
+        )
+
+    def close(self) -> None:
+        """
+        Persist pending conversation changes and close context.db
+        """
+        self.conversation.flush()
+        self.writer.close()
+        logger.info(
+            f"Conversation cache stats: {self.conversation.stats()}, "
+            f"context db: {self.writer.statements} writes "
+            f"in {self.writer.batches} commits, {self.writer.failed} failed"
+        )
+        self.cursor.close()
+        self.conn.close()
+
+    def get_token_count(self, convo_id: str = "default") -> int:
+        """
+        Get token count
+        """
+        # every reply is primed with <im_start>assistant
+        return self.conversation[convo_id].total_tokens + 5
+
     def get_max_tokens(self, convo_id: str) -> int:
         """
         Get max tokens
         """
         return self.max_tokens - self.get_token_count(convo_id)
 
+    def _model(self, endpoint: Endpoint, json_body: dict, model: str = None) -> str:
+        """
+        Model actually called: the override of the endpoint,
+        unless the caller asked for a model
+        """
+        if model is None and endpoint.model:
+            return endpoint.model
+        return json_body["model"]
+
+    def _keys(self, endpoint: Endpoint) -> list[str]:
+        if endpoint.api_keys:
+            return endpoint.api_keys
+        return [endpoint.api_key] if endpoint.api_key else self.api_keys
+
+    @retry(
+        retry=retry_if_exception(is_retryable),
+        wait=wait_retryable,
+        stop=stop_after_attempt(3),
+        reraise=True,
+    )
+    async def _send_request(
+        self,
+        json_body: dict,
+        model: str = None,
+        candidates: Optional[list[Endpoint]] = None,
+        **kwargs,
+    ) -> tuple[Endpoint, httpx.Response]:
+        """
+        Send a chat completions request, on connection errors, timeouts and
+        retryable statuses try the next endpoint. Return as soon as the response
+        headers arrive, the caller reads and closes the response.
+        When every endpoint failed the whole round is retried,
+        with breakers that opened during the round taken into account
+        """
+        if candidates is None:
+            candidates = self.router.candidates()
+        else:
+            candidates = self.router.reorder(candidates)
+        for i, endpoint in enumerate(candidates):
+            is_last = i == len(candidates) - 1
+            key = kwargs.get("api_key") or self.rate_limiter.pick_key(
+                endpoint.name, self._keys(endpoint)
+            )
+            try:
+                await self.rate_limiter.acquire(endpoint.name, key)
+            except RateLimitExceeded as e:
+                if is_last:
+                    raise
+                logger.warning(f"{e}, failing over")
+                continue
+
+            body = dict(json_body)
+            body["model"] = self._model(endpoint, json_body, model)
+            request = self.aclient.build_request(
+                "POST",
+                endpoint.url,
+                headers={"Authorization": f"Bearer {key}"},
+                json=body,
+                timeout=kwargs.get("timeout", self.timeout),
+            )
+            self.router.start(endpoint)
+            start = time.perf_counter()
+            try:
+                if self.endpoint_failover_timeout and not is_last:
+                    response = await asyncio.wait_for(
+                        self.aclient.send(request, stream=True),
+                        self.endpoint_failover_timeout,
+                    )
+                else:
+                    response = await self.aclient.send(request, stream=True)
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                self.router.record_failure(endpoint, repr(e))
+                if is_last:
+                    raise
+                logger.warning(f"Endpoint {endpoint.name} failed, failing over: {e!r}")
+                continue
+            except asyncio.CancelledError:
+                # the losing request of a hedge, says nothing about the endpoint
+                self.router.cancel(endpoint)
+                raise
+
+            self.rate_limiter.update(endpoint.name, key, response)
+            if response.status_code not in FAILOVER_STATUS:
+                self.router.record_success(endpoint, time.perf_counter() - start)
+                return endpoint, response
+
+            # a rate limited key doesn't make the endpoint unhealthy
+            if response.status_code == 429:
+                self.router.cancel(endpoint)
+            else:
+                self.router.record_failure(endpoint, str(response.status_code))
+            if is_last:
+                try:
+                    raise await APIError.from_response(response)
+                finally:
+                    await response.aclose()
+            logger.warning(
+                f"Endpoint {endpoint.name} returned {response.status_code}, failing over"  # noqa: E501
+            )
+            await response.aclose()
+
+    async def _post(
+        self,
+        json_body: dict,
+        model: str = None,
+        candidates: Optional[list[Endpoint]] = None,
+        **kwargs,
+    ) -> tuple[Endpoint, httpx.Response]:
+        """
+        Non-streaming request with failover,
+        return the endpoint that answered and the read response
+        """
+        endpoint, response = await self._send_request(
+            json_body, model=model, candidates=candidates, **kwargs
+        )
+        try:
+            if not response.is_success:
+                raise await APIError.from_response(response)
+            await response.aread()
+        finally:
+            await response.aclose()
+        return endpoint, response
+
+    async def _post_hedged(
+        self, json_body: dict, model: str = None, **kwargs
+    ) -> tuple[Endpoint, httpx.Response]:
+        """
+        Like _post, but when no response arrived within the hedge delay send
+        a duplicate request, to another endpoint if there is one.
+        The first response wins and the other request is cancelled
+        """
+        candidates = self.router.candidates()
+        # the hedge tries the other endpoints first, then the same one
+        hedge_candidates = candidates[1:] + candidates[:1]
+
+        async def attempt(
+            candidates: list[Endpoint],
+        ) -> tuple[float, tuple[Endpoint, httpx.Response]]:
+            start = time.perf_counter()
+            result = await self._post(
+                json_body, model=model, candidates=candidates, **kwargs
+            )
+            return time.perf_counter() - start, result
+
+        delay = self.hedging.delay()
+        primary = asyncio.create_task(attempt(candidates))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if self.hedging.acquire():
+                    logger.info(f"No response after {delay:.2f}s, hedging request")
+                    tasks.add(asyncio.create_task(attempt(hedge_candidates)))
+                else:
+                    HEDGED_REQUESTS.inc(outcome="no_budget")
+
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # prefer the primary when both finished together
+                for task in sorted(done, key=lambda task: task is not primary):
+                    if task.exception() is not None:
+                        continue
+                    latency, result = task.result()
+                    self.hedging.observe(latency)
+                    if len(tasks) > 1:
+                        if task is not primary:
+                            self.hedging.hedge_wins += 1
+                        HEDGED_REQUESTS.inc(
+                            outcome="primary" if task is primary else "hedge"
+                        )
+                    return result
+            # every request failed, raise the error of the primary
+            return primary.result()[1]
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def ask_stream_async(
         self,
         prompt: str,
@@ -192,18 +730,27 @@ class Chatbot:
         Ask a question
         """
         # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
+        if await self.conversation.get_async(convo_id) is None:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
+        await self.add_to_conversation_async(prompt, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
+        prompt_tokens = self.get_token_count(convo_id)
         # Get response
-        async with self.aclient.stream(
-            "post",
-            self.api_url,
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json={
+        # o1 beta-limitations
+        if self.engine in GPT_O_MODEL:
+            json_body = {
+                "model": model or self.engine,
+                "messages": self.conversation[convo_id].messages if pass_history else [prompt],
+                "stream": True,
+                "max_completion_tokens": min(
+                    self.get_max_tokens(convo_id=convo_id),
+                    kwargs.get("max_tokens", self.max_tokens),
+                ),
+            }
+        else:
+            json_body = {
                 "model": model or self.engine,
-                "messages": self.conversation[convo_id] if pass_history else [prompt],
+                "messages": self.conversation[convo_id].messages if pass_history else [prompt],
                 "stream": True,
                 # kwargs
                 "temperature": kwargs.get("temperature", self.temperature),
@@ -222,41 +769,30 @@ class Chatbot:
                     self.get_max_tokens(convo_id=convo_id),
                     kwargs.get("max_tokens", self.max_tokens),
                 ),
-            },
-            timeout=kwargs.get("timeout", self.timeout),
-        ) as response:
-            if response.status_code != 200:
-                await response.aread()
-                raise Exception(
-                    f"{response.status_code} {response.reason_phrase} {response.text}",
-                )
-
-            response_role: str = ""
+            }
+        endpoint, response = await self._send_request(json_body, model=model, **kwargs)
+        try:
+            response_role: str = "assistant"
             full_response: str = ""
-            async for line in response.aiter_lines():
-                line = line.strip()
-                if not line:
-                    continue
-                # Remove "data: "
-                line = line[6:]
-                if line == "[DONE]":
-                    break
-                resp: dict = json.loads(line)
-                if "error" in resp:
-                    raise Exception(f"{resp['error']}")
-                choices = resp.get("choices")
-                if not choices:
-                    continue
-                delta: dict[str, str] = choices[0].get("delta")
-                if not delta:
-                    continue
-                if "role" in delta:
+            async for delta in iter_stream_deltas(response):
+                if delta.get("role"):
                     response_role = delta["role"]
-                if "content" in delta:
+                if delta.get("content"):
                     content: str = delta["content"]
                     full_response += content
                     yield content
-        self.add_to_conversation(full_response, response_role, convo_id=convo_id)
+        except httpx.TransportError as e:
+            self.router.record_failure(endpoint, repr(e))
+            raise
+        finally:
+            await response.aclose()
+        completion_tokens = await self.add_to_conversation_async(
+            full_response, response_role, convo_id=convo_id
+        )
+        self._observe_usage(
+            self._model(endpoint, json_body, model),
+            {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+        )
 
     async def ask_async(
         self,
@@ -291,58 +827,55 @@ class Chatbot:
         **kwargs,
     ) -> str:
         # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
+        if await self.conversation.get_async(convo_id) is None:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
+        await self.add_to_conversation_async(prompt, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
+        prompt_tokens = self.get_token_count(convo_id)
         # Get response
         # o1 beta-limitations
         if self.engine in GPT_O_MODEL:
-            response = await self.aclient.post(
-                url=self.api_url,
-                headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-                json={
-                    "model": model or self.engine,
-                    "messages": self.conversation[convo_id] if pass_history else [prompt],
-                    "max_completion_tokens": min(
-                        self.get_max_tokens(convo_id=convo_id),
-                        kwargs.get("max_tokens", self.max_tokens),
-                    ),
-                },
-                timeout=kwargs.get("timeout", self.timeout),
-            )
+            json_body = {
+                "model": model or self.engine,
+                "messages": self.conversation[convo_id].messages if pass_history else [prompt],
+                "max_completion_tokens": min(
+                    self.get_max_tokens(convo_id=convo_id),
+                    kwargs.get("max_tokens", self.max_tokens),
+                ),
+            }
         else:
-            response = await self.aclient.post(
-                url=self.api_url,
-                headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-                json={
-                    "model": model or self.engine,
-                    "messages": self.conversation[convo_id] if pass_history else [prompt],
-                    # kwargs
-                    "temperature": kwargs.get("temperature", self.temperature),
-                    "top_p": kwargs.get("top_p", self.top_p),
-                    "presence_penalty": kwargs.get(
-                        "presence_penalty",
-                        self.presence_penalty,
-                    ),
-                    "frequency_penalty": kwargs.get(
-                        "frequency_penalty",
-                        self.frequency_penalty,
-                    ),
-                    "n": kwargs.get("n", self.reply_count),
-                    "user": role,
-                    "max_tokens": min(
-                        self.get_max_tokens(convo_id=convo_id),
-                        kwargs.get("max_tokens", self.max_tokens),
-                    ),
-                },
-                timeout=kwargs.get("timeout", self.timeout),
-            )
+            json_body = {
+                "model": model or self.engine,
+                "messages": self.conversation[convo_id].messages if pass_history else [prompt],
+                # kwargs
+                "temperature": kwargs.get("temperature", self.temperature),
+                "top_p": kwargs.get("top_p", self.top_p),
+                "presence_penalty": kwargs.get(
+                    "presence_penalty",
+                    self.presence_penalty,
+                ),
+                "frequency_penalty": kwargs.get(
+                    "frequency_penalty",
+                    self.frequency_penalty,
+                ),
+                "n": kwargs.get("n", self.reply_count),
+                "user": role,
+                "max_tokens": min(
+                    self.get_max_tokens(convo_id=convo_id),
+                    kwargs.get("max_tokens", self.max_tokens),
+                ),
+            }
+        endpoint, response = await self._post(json_body, model=model, **kwargs)
         resp = response.json()
         full_response = resp["choices"][0]["message"]["content"]
-        self.add_to_conversation(
+        completion_tokens = await self.add_to_conversation_async(
             full_response, resp["choices"][0]["message"]["role"], convo_id=convo_id
         )
+        self._observe_usage(
+            self._model(endpoint, json_body, model),
+            resp.get("usage")
+            or {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+        )
         return full_response
 
     def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
@@ -351,14 +884,16 @@ class Chatbot:
         """
         # o1 beta-limitations
         if self.engine in GPT_O_MODEL:
-            self.conversation[convo_id] = []
+            conversation = self._new_conversation([])
         else:
-            self.conversation[convo_id] = [
-                {"role": "system", "content": system_prompt or self.system_prompt},
-            ]
-        self._save_conversation(convo_id)
+            conversation = self._new_conversation(
+                [
+                    {"role": "system", "content": system_prompt or self.system_prompt},
+                ]
+            )
+        self.conversation[convo_id] = conversation
+        self._save_conversation(convo_id, conversation)
 
-    @retry(wait=wait_random_exponential(min=2, max=5), stop=stop_after_attempt(3))
     async def oneTimeAsk(
         self,
         prompt: str,
@@ -366,50 +901,111 @@ class Chatbot:
         model: str = None,
         **kwargs,
     ) -> str:
+        post = self._post_hedged if self.hedging is not None else self._post
         # o1 beta-limitations
         if self.engine in GPT_O_MODEL:
-            response = await self.aclient.post(
-                url=self.api_url,
-                json={
-                    "model": model or self.engine,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": prompt,
-                        }
-                    ],
-                    "max_completion_tokens": kwargs.get("max_tokens", self.max_tokens),
-                },
-                headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-                timeout=kwargs.get("timeout", self.timeout),
-        )
+            json_body = {
+                "model": model or self.engine,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                "max_completion_tokens": kwargs.get("max_tokens", self.max_tokens),
+            }
         else:
-            response = await self.aclient.post(
-                url=self.api_url,
-                json={
-                    "model": model or self.engine,
-                    "messages": [
-                        {
-                            "role": role,
-                            "content": prompt,
-                        }
-                    ],
-                    # kwargs
-                    "temperature": kwargs.get("temperature", self.temperature),
-                    "top_p": kwargs.get("top_p", self.top_p),
-                    "presence_penalty": kwargs.get(
-                        "presence_penalty",
-                        self.presence_penalty,
-                    ),
-                    "frequency_penalty": kwargs.get(
-                        "frequency_penalty",
-                        self.frequency_penalty,
-                    ),
-                    "user": role,
-                    "max_tokens": kwargs.get("max_tokens", self.max_tokens),
-                },
-                headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-                timeout=kwargs.get("timeout", self.timeout),
-            )
+            json_body = {
+                "model": model or self.engine,
+                "messages": [
+                    {
+                        "role": role,
+                        "content": prompt,
+                    }
+                ],
+                # kwargs
+                "temperature": kwargs.get("temperature", self.temperature),
+                "top_p": kwargs.get("top_p", self.top_p),
+                "presence_penalty": kwargs.get(
+                    "presence_penalty",
+                    self.presence_penalty,
+                ),
+                "frequency_penalty": kwargs.get(
+                    "frequency_penalty",
+                    self.frequency_penalty,
+                ),
+                "user": role,
+                "max_tokens": kwargs.get("max_tokens", self.max_tokens),
+            }
+        endpoint, response = await post(json_body, model=model, **kwargs)
         resp = response.json()
-        return resp["choices"][0]["message"]["content"]
+        content = resp["choices"][0]["message"]["content"]
+        self._observe_usage(
+            self._model(endpoint, json_body, model),
+            resp.get("usage") or await self._count_usage(prompt, content),
+        )
+        return content
+
+    async def oneTimeAskStream(
+        self,
+        prompt: str,
+        role: str = "user",
+        model: str = None,
+        **kwargs,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Streaming one time ask
+        """
+        # o1 beta-limitations
+        if self.engine in GPT_O_MODEL:
+            json_body = {
+                "model": model or self.engine,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                "stream": True,
+                "max_completion_tokens": kwargs.get("max_tokens", self.max_tokens),
+            }
+        else:
+            json_body = {
+                "model": model or self.engine,
+                "messages": [
+                    {
+                        "role": role,
+                        "content": prompt,
+                    }
+                ],
+                "stream": True,
+                # kwargs
+                "temperature": kwargs.get("temperature", self.temperature),
+                "top_p": kwargs.get("top_p", self.top_p),
+                "presence_penalty": kwargs.get(
+                    "presence_penalty",
+                    self.presence_penalty,
+                ),
+                "frequency_penalty": kwargs.get(
+                    "frequency_penalty",
+                    self.frequency_penalty,
+                ),
+                "user": role,
+                "max_tokens": kwargs.get("max_tokens", self.max_tokens),
+            }
+        endpoint, response = await self._send_request(json_body, model=model, **kwargs)
+        try:
+            full_response = ""
+            async for delta in iter_stream_deltas(response):
+                if delta.get("content"):
+                    full_response += delta["content"]
+                    yield delta["content"]
+        except httpx.TransportError as e:
+            self.router.record_failure(endpoint, repr(e))
+            raise
+        finally:
+            await response.aclose()
+        self._observe_usage(
+            self._model(endpoint, json_body, model),
+            await self._count_usage(prompt, full_response),
+        )
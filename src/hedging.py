@@ -0,0 +1,78 @@
+"""
+Hedged requests: when a request is slower than most recent ones,
+send a duplicate and keep whichever answers first
+"""
+from collections import deque
+import math
+from typing import Optional
+
+# hedging starts once this many latencies were recorded
+MIN_SAMPLES = 20
+# unused budget saved for bursts of slow requests, in requests
+BUDGET_BURST = 10.0
+
+
+class HedgePolicy:
+    """
+    percentile: hedge a request once it is slower than this percentile
+    of the recent latencies
+    budget: extra requests as a fraction of all requests,
+    0.05 adds at most 5% traffic
+    window: number of recent latencies kept
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        budget: float = 0.05,
+        window: int = 200,
+    ) -> None:
+        self.percentile = percentile
+        self.budget = budget
+        self.samples: deque[float] = deque(maxlen=window)
+        self.tokens = 0.0
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+
+    def delay(self) -> Optional[float]:
+        """
+        Seconds to wait before hedging a new request, None while there are
+        not enough samples. Every call counts as a request for the budget
+        """
+        self.requests += 1
+        self.tokens = min(self.tokens + self.budget, BUDGET_BURST)
+        return self._threshold()
+
+    def _threshold(self) -> Optional[float]:
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        index = math.ceil(self.percentile / 100 * len(samples)) - 1
+        return samples[max(index, 0)]
+
+    def acquire(self) -> bool:
+        """
+        Take budget for one hedge request
+        """
+        if self.tokens < 1:
+            self.skipped += 1
+            return False
+        self.tokens -= 1
+        self.hedged += 1
+        return True
+
+    def observe(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def stats(self) -> dict:
+        threshold = self._threshold()
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "skipped": self.skipped,
+            "delay": round(threshold, 3) if threshold is not None else None,
+        }
@@ -0,0 +1,145 @@
+"""
+One httpx connection pool per upstream, so a slow backend can't take
+the connections another one needs
+"""
+import asyncio
+from typing import Optional
+
+import httpx
+
+from log import getlogger
+from metrics import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAX_CONNECTIONS,
+    HTTP_POOL_QUEUED,
+    MetricsTransport,
+)
+
+logger = getlogger()
+
+# chat: chat completions, vision: gpt vision, image: image generation,
+# flowise: !lc agents, homeserver: requests to the homeserver outside of nio
+UPSTREAMS = ["chat", "vision", "image", "flowise", "homeserver"]
+
+DEFAULT_LIMITS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 5.0,
+}
+
+
+class HTTPPools:
+    """
+    timeout: default request timeout in seconds
+    limits: upstream name -> max_connections, max_keepalive_connections and
+    keepalive_expiry, missing values fall back to DEFAULT_LIMITS
+    http2: negotiate HTTP/2 where the upstream supports it, needs the h2 package
+    metrics: record upstream timings with MetricsTransport
+    """
+
+    def __init__(
+        self,
+        timeout: float = 120.0,
+        limits: Optional[dict[str, dict]] = None,
+        http2: bool = False,
+        metrics: bool = False,
+    ) -> None:
+        self.timeout = timeout
+        self.http2 = http2
+        self.limits: dict[str, dict] = {}
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, httpx.AsyncHTTPTransport] = {}
+        self._pool_stats_failed = False
+
+        limits = limits or {}
+        for name in UPSTREAMS:
+            self.limits[name] = {**DEFAULT_LIMITS, **limits.get(name, {})}
+            transport = httpx.AsyncHTTPTransport(
+                http2=http2, limits=httpx.Limits(**self.limits[name])
+            )
+            self._transports[name] = transport
+            self._clients[name] = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=timeout,
+                transport=MetricsTransport(transport) if metrics else transport,
+            )
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        return self._clients[name]
+
+    async def prewarm(self, urls: dict[str, list[Optional[str]]]) -> None:
+        """
+        Open a connection to each upstream, including the TLS handshake,
+        so the first user request doesn't pay for it.
+        urls: upstream name -> urls of the upstream, one connection per origin
+        """
+
+        async def warm(name: str, url: str) -> None:
+            try:
+                # any answer will do, the connection is kept alive in the pool
+                await self._clients[name].head(url, timeout=10)
+                logger.info(f"Prewarmed {name} connection to {httpx.URL(url).host}")
+            except Exception as e:
+                logger.warning(f"Failed to prewarm {name} connection to {url}: {e}")
+
+        jobs = []
+        for name, upstream_urls in urls.items():
+            origins = set()
+            for url in upstream_urls:
+                if not url:
+                    continue
+                origin = httpx.URL(url).copy_with(path="/", query=None, fragment=None)
+                if origin not in origins:
+                    origins.add(origin)
+                    jobs.append(warm(name, url))
+        await asyncio.gather(*jobs)
+
+    def _pool_stats(self, transport: httpx.AsyncHTTPTransport) -> Optional[dict]:
+        # httpx has no public API for the state of its pool, read the httpcore
+        # pool it wraps and give up quietly if a new version changed it
+        try:
+            connections = transport._pool.connections
+            idle = sum(1 for connection in connections if connection.is_idle())
+            # requests waiting for a connection, the pool is saturated
+            queued = sum(
+                1
+                for request in getattr(transport._pool, "_requests", [])
+                if request.is_queued()
+            )
+        except Exception as e:
+            if not self._pool_stats_failed:
+                self._pool_stats_failed = True
+                logger.warning(f"HTTP pool stats unavailable with this httpx: {e!r}")
+            return None
+        return {
+            "connections": len(connections),
+            "active": len(connections) - idle,
+            "idle": idle,
+            "queued": queued,
+        }
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Connections and queued requests of each pool,
+        only the limits if the httpx version doesn't expose them
+        """
+        stats = {}
+        for name, transport in self._transports.items():
+            stats[name] = {
+                **(self._pool_stats(transport) or {}),
+                "max_connections": self.limits[name]["max_connections"],
+            }
+        return stats
+
+    def collect_metrics(self) -> None:
+        for name, stats in self.stats().items():
+            HTTP_POOL_MAX_CONNECTIONS.set(stats["max_connections"], pool=name)
+            if "active" not in stats:
+                continue
+            HTTP_POOL_CONNECTIONS.set(stats["active"], pool=name, state="active")
+            HTTP_POOL_CONNECTIONS.set(stats["idle"], pool=name, state="idle")
+            HTTP_POOL_QUEUED.set(stats["queued"], pool=name)
+
+    async def aclose(self) -> None:
+        for client in self._clients.values():
+            await client.aclose()
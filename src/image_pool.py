@@ -0,0 +1,127 @@
+"""
+Run CPU bound image work, decoding and encoding with Pillow,
+in a pool of threads or processes instead of on the event loop
+"""
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import time
+from typing import Any, Callable
+
+from log import getlogger
+from metrics import IMAGE_QUEUE_WAIT_SECONDS, IMAGE_WORK_SECONDS
+
+logger = getlogger()
+
+
+class ImagePoolFull(Exception):
+    pass
+
+
+def _timed(fn: Callable, *args) -> tuple[Any, float]:
+    # runs in the worker, so the time excludes the wait for a worker
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class ImagePool:
+    """
+    kind: thread or process. Pillow releases the GIL while decoding
+        and encoding, processes also run the Python parts in parallel
+    workers: jobs running at the same time
+    max_queue: jobs waiting for a worker, more are rejected with ImagePoolFull
+
+    With processes, fn and its arguments must be picklable,
+    fn a module level function.
+    """
+
+    def __init__(
+        self, kind: str = "thread", workers: int = 2, max_queue: int = 32
+    ) -> None:
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor: Executor
+        if kind == "process":
+            # fork is not safe with the threads of a running bot
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="image"
+            )
+
+        self.pending = 0
+
+        # op -> [jobs, errors, work seconds, wait seconds]
+        self._ops: dict[str, list] = {}
+        self.rejected = 0
+        self.max_pending = 0
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    async def run(self, op: str, fn: Callable, *args) -> Any:
+        """
+        Run fn(*args) in the pool and return its result.
+        op: name of the operation in metrics and stats
+        """
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise ImagePoolFull(f"Image queue full, {self.pending} jobs pending")
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        future = self.executor.submit(_timed, fn, *args)
+        # the job keeps its place until the worker is done with it,
+        # even if the caller is cancelled
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        future.add_done_callback(lambda _: self._release(loop))
+        entry = self._ops.setdefault(op, [0, 0, 0.0, 0.0])
+        try:
+            result, work = await asyncio.wrap_future(future)
+        except Exception:
+            entry[1] += 1
+            raise
+        wait = max(0.0, time.perf_counter() - submitted - work)
+        entry[0] += 1
+        entry[2] += work
+        entry[3] += wait
+        IMAGE_WORK_SECONDS.observe(work, op=op)
+        IMAGE_QUEUE_WAIT_SECONDS.observe(wait, op=op)
+        return result
+
+    def _release(self, loop: asyncio.AbstractEventLoop) -> None:
+        # called from the worker thread, or the one collecting process results
+        try:
+            loop.call_soon_threadsafe(self._done)
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+    def _done(self) -> None:
+        self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            **{
+                op: {
+                    "jobs": jobs,
+                    "errors": errors,
+                    "work_seconds": round(work, 3),
+                    "wait_seconds": round(wait, 3),
+                }
+                for op, (jobs, errors, work, wait) in self._ops.items()
+            },
+        }
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
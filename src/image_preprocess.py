@@ -0,0 +1,154 @@
+"""
+Downscale and recompress images before they are sent to a vision model
+"""
+import io
+
+from PIL import Image, ImageOps
+
+from image_pool import ImagePool
+from log import getlogger
+
+logger = getlogger()
+
+FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+# JPEG segments kept when stripping metadata: JFIF, ICC profile and Adobe
+KEEP_SEGMENTS = {
+    0xE0: (b"JFIF\0", b"JFXX\0"),
+    0xE2: (b"ICC_PROFILE\0",),
+    0xEE: (b"Adobe",),
+}
+SOS = 0xDA
+COM = 0xFE
+ORIENTATION = 0x0112
+
+
+def strip_jpeg_metadata(body: bytes) -> bytes:
+    """
+    Drop the EXIF, XMP, IPTC and comment segments of a JPEG
+    without decoding it
+    """
+    if body[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG")
+    out = bytearray(body[:2])
+    pos = 2
+    while pos + 4 <= len(body):
+        if body[pos] != 0xFF:
+            raise ValueError("invalid JPEG marker")
+        marker = body[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker == SOS:
+            out += body[pos:]
+            return bytes(out)
+        end = pos + 2 + int.from_bytes(body[pos + 2 : pos + 4], "big")
+        if 0xE0 <= marker <= 0xEF or marker == COM:
+            keep = KEEP_SEGMENTS.get(marker, ())
+            if keep and body[pos + 4 : end].startswith(keep):
+                out += body[pos:end]
+        else:
+            out += body[pos:end]
+        pos = end
+    raise ValueError("JPEG without image data")
+
+
+def preprocess(
+    body: bytes, mimetype: str, max_side: int, quality: int, format: str
+) -> tuple[bytes, str]:
+    with Image.open(io.BytesIO(body)) as im:
+        original_format = im.format
+        orientation = im.getexif().get(ORIENTATION, 1)
+        # let the JPEG decoder skip the detail the downscale drops
+        if im.format == "JPEG":
+            im.draft("RGB", (max_side, max_side))
+        # the EXIF orientation is dropped with the metadata, apply it first
+        im = ImageOps.exif_transpose(im)
+        size = im.size
+        resized = max(size) > max_side
+        if resized:
+            im.thumbnail((max_side, max_side), Image.LANCZOS)
+        if im.mode in ("P", "PA", "LA"):
+            im = im.convert("RGBA")
+        if im.mode == "RGBA" and format == "jpeg":
+            background = Image.new("RGB", im.size, (255, 255, 255))
+            background.paste(im, mask=im.getchannel("A"))
+            im = background
+        elif im.mode not in ("RGB", "RGBA", "L"):
+            im = im.convert("RGB")
+        out = io.BytesIO()
+        # Pillow writes back comments and XMP kept in info, drop them
+        # and save without exif or icc_profile to strip the metadata
+        im.info = {}
+        im.save(out, format=format, quality=quality)
+    data = out.getvalue()
+    # a small image can grow when re-encoded, then keep the original
+    # without its metadata, unless its pixels had to be rotated
+    if (
+        not resized
+        and len(data) >= len(body)
+        and original_format == "JPEG"
+        and orientation == 1
+    ):
+        return strip_jpeg_metadata(body), mimetype
+    return data, FORMATS[format]
+
+
+class ImagePreprocessor:
+    """
+    max_side: longest side in pixels, larger images are downscaled
+    quality: quality of the re-encoded image, 1 to 100
+    format: jpeg or webp
+    pool: where images are decoded and encoded, off the event loop
+    """
+
+    def __init__(
+        self,
+        pool: ImagePool,
+        max_side: int = 2048,
+        quality: int = 85,
+        format: str = "jpeg",
+    ) -> None:
+        self.pool = pool
+        self.max_side = max_side
+        self.quality = quality
+        self.format = format
+
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def process(self, body: bytes, mimetype: str) -> tuple[bytes, str]:
+        """
+        Return the processed image and its mimetype,
+        the original if it can't be decoded
+        """
+        try:
+            data, out_mimetype = await self.pool.run(
+                "vision",
+                preprocess,
+                body,
+                mimetype,
+                self.max_side,
+                self.quality,
+                self.format,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to preprocess image, sending the original: {e}")
+            return body, mimetype
+        self.images += 1
+        self.bytes_in += len(body)
+        self.bytes_out += len(data)
+        logger.info(
+            f"Vision image {len(body)} -> {len(data)} bytes, "
+            f"{len(body) - len(data)} bytes saved"
+        )
+        return data, out_mimetype
+
+    def stats(self) -> dict:
+        return {
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
@@ -0,0 +1,161 @@
+"""
+Queue image generation jobs in front of a backend,
+with a limit of calls at the same time and batching of identical jobs
+"""
+import asyncio
+from collections import deque
+import time
+from typing import Awaitable, Callable, Optional
+
+from imagegen import GeneratedImage
+from log import getlogger
+from metrics import IMAGE_BATCH_SIZE, IMAGE_JOB_WAIT_SECONDS
+
+logger = getlogger()
+
+
+class ImageBatch:
+    """
+    Jobs with the same parameters, generated by one backend call
+    """
+
+    def __init__(self, params: dict) -> None:
+        self.params = params
+        # enqueue time and future of each job
+        self.jobs: list[tuple[float, asyncio.Future]] = []
+
+    def add(self, future: asyncio.Future) -> None:
+        self.jobs.append((time.monotonic(), future))
+
+
+class ImageJobScheduler:
+    """
+    generate: coroutine function of the job parameters and a number of images,
+        returning the images
+    concurrency: backend calls running at the same time
+    max_batch: jobs with the same parameters generated by one call, 1 to disable
+    max_queue: jobs waiting for a call, more are rejected
+
+    Each job asks for a single image.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[dict, int], Awaitable[list[GeneratedImage]]],
+        concurrency: int = 1,
+        max_batch: int = 4,
+        max_queue: int = 20,
+    ) -> None:
+        self.generate = generate
+        self.concurrency = concurrency
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+
+        self._batches: deque[ImageBatch] = deque()
+        self._tasks: set[asyncio.Task] = set()
+
+        self.inflight = 0
+        self.queued = 0
+
+        self.submitted = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.calls = 0
+        self.failed = 0
+        self.max_queued = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def submit(self, **params) -> Optional[tuple[int, asyncio.Future]]:
+        """
+        Queue a job, return its position in the queue, 0 if it started
+        right away, and a future of its images. None if the queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.inflight < self.concurrency and not self._batches:
+            self.submitted += 1
+            batch = ImageBatch(params)
+            batch.add(future)
+            self._start(batch)
+            return 0, future
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            logger.warning("Image queue full, rejected image job")
+            return None
+
+        self.submitted += 1
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        for position, batch in enumerate(self._batches, 1):
+            if batch.params == params and len(batch.jobs) < self.max_batch:
+                self.coalesced += 1
+                batch.add(future)
+                return position, future
+        batch = ImageBatch(params)
+        batch.add(future)
+        self._batches.append(batch)
+        return len(self._batches), future
+
+    def _start(self, batch: ImageBatch) -> None:
+        self.inflight += 1
+        self.calls += 1
+        now = time.monotonic()
+        for enqueued_at, _ in batch.jobs:
+            waited = now - enqueued_at
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            IMAGE_JOB_WAIT_SECONDS.observe(waited)
+        IMAGE_BATCH_SIZE.observe(len(batch.jobs))
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    async def _run(self, batch: ImageBatch) -> None:
+        try:
+            images = await self.generate(batch.params, len(batch.jobs))
+            if images is None or len(images) < len(batch.jobs):
+                raise Exception(
+                    f"Backend returned {len(images or [])} images "
+                    f"for {len(batch.jobs)} jobs"
+                )
+        except Exception as e:
+            self.failed += 1
+            for _, future in batch.jobs:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), image in zip(batch.jobs, images):
+            if not future.done():
+                future.set_result([image])
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self.inflight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.inflight < self.concurrency and self._batches:
+            batch = self._batches.popleft()
+            self.queued -= len(batch.jobs)
+            # skip jobs whose caller went away while waiting
+            batch.jobs = [job for job in batch.jobs if not job[1].done()]
+            if batch.jobs:
+                self._start(batch)
+
+    def stats(self) -> dict:
+        started = self.submitted - self.queued
+        return {
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "calls": self.calls,
+            "failed": self.failed,
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "wait_seconds_avg": round(self.wait_seconds_total / started, 3)
+            if started
+            else 0.0,
+        }
@@ -1,3 +1,4 @@
+import asyncio
 import httpx
 from pathlib import Path
 import uuid
@@ -5,15 +6,40 @@ import base64
 import io
 from PIL import Image
 
+FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+
+class GeneratedImage:
+    """
+    An encoded image kept in memory, with what the upload needs to know
+    """
+
+    def __init__(self, body: bytes, format: str, width: int, height: int) -> None:
+        self.body = body
+        self.format = format
+        self.mimetype = FORMATS[format]
+        self.width = width
+        self.height = height
+        self.filename = str(uuid.uuid4()) + "." + format
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+    def save(self, path: Path) -> Path:
+        image_path = Path(path) / self.filename
+        with open(image_path, "wb") as f:
+            f.write(self.body)
+        return image_path
+
 
 async def get_images(
     aclient: httpx.AsyncClient,
     url: str,
     prompt: str,
     backend_type: str,
-    output_path: str,
     **kwargs,
-) -> list[str]:
+) -> list[GeneratedImage]:
     timeout = kwargs.get("timeout", 180.0)
     if backend_type == "openai":
         resp = await aclient.post(
@@ -35,7 +61,7 @@ async def get_images(
             b64_datas = []
             for data in resp.json()["data"]:
                 b64_datas.append(data["b64_json"])
-            return save_images_b64(b64_datas, output_path, **kwargs)
+            return await load_images_b64(b64_datas, **kwargs)
         else:
             raise Exception(
                 f"{resp.status_code} {resp.reason_phrase} {resp.text}",
@@ -59,7 +85,7 @@ async def get_images(
         )
         if resp.status_code == 200:
             b64_datas = resp.json()["images"]
-            return save_images_b64(b64_datas, output_path, **kwargs)
+            return await load_images_b64(b64_datas, **kwargs)
         else:
             raise Exception(
                 f"{resp.status_code} {resp.reason_phrase} {resp.text}",
@@ -79,29 +105,64 @@ async def get_images(
         )
         if resp.status_code == 200:
             image_url = resp.json()["data"][0]["url"]
-            return await save_image_url(image_url, aclient, output_path, **kwargs)
+            return await fetch_image_url(image_url, aclient, **kwargs)
+        else:
+            raise Exception(
+                f"{resp.status_code} {resp.reason_phrase} {resp.text}",
+            )
+
+
+def load_image(body: bytes, image_format: str = "jpeg") -> GeneratedImage:
+    """
+    Read the size from the image header, and re-encode the image
+    only if the backend didn't return it in image_format
+    """
+    with Image.open(io.BytesIO(body)) as img:
+        width, height = img.size
+        if img.format.lower() == image_format:
+            return GeneratedImage(body, image_format, width, height)
+        if image_format == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format)
+    return GeneratedImage(buffer.getvalue(), image_format, width, height)
+
 
+def load_image_b64(b64_data: str, image_format: str = "jpeg") -> GeneratedImage:
+    return load_image(base64.b64decode(b64_data), image_format)
 
-def save_images_b64(b64_datas: list[str], path: Path, **kwargs) -> list[str]:
-    images_path_list = []
-    for b64_data in b64_datas:
-        image_path = path / (
-            str(uuid.uuid4()) + "." + kwargs.get("image_format", "jpeg")
+
+def decode_images_b64(b64_datas: list[str], **kwargs) -> list[GeneratedImage]:
+    image_format = kwargs.get("image_format") or "jpeg"
+    return [load_image_b64(b64_data, image_format) for b64_data in b64_datas]
+
+
+async def load_images_b64(b64_datas: list[str], **kwargs) -> list[GeneratedImage]:
+    """
+    Decode the images in kwargs pool, an ImagePool, or on the event loop without it
+    """
+    pool = kwargs.get("pool")
+    if pool is None:
+        return decode_images_b64(b64_datas, **kwargs)
+    image_format = kwargs.get("image_format") or "jpeg"
+    return list(
+        await asyncio.gather(
+            *(
+                pool.run("generate", load_image_b64, b64_data, image_format)
+                for b64_data in b64_datas
+            )
         )
-        img = Image.open(io.BytesIO(base64.decodebytes(bytes(b64_data, "utf-8"))))
-        img.save(image_path)
-        images_path_list.append(image_path)
-    return images_path_list
+    )
 
 
-async def save_image_url(
-    url: str, aclient: httpx.AsyncClient, path: Path, **kwargs
-) -> list[str]:
-    images_path_list = []
+async def fetch_image_url(
+    url: str, aclient: httpx.AsyncClient, **kwargs
+) -> list[GeneratedImage]:
     r = await aclient.get(url)
-    image_path = path / (str(uuid.uuid4()) + "." + kwargs.get("image_format", "jpeg"))
     if r.status_code == 200:
-        img = Image.open(io.BytesIO(r.content))
-        img.save(image_path)
-        images_path_list.append(image_path)
-    return images_path_list
+        pool = kwargs.get("pool")
+        image_format = kwargs.get("image_format") or "jpeg"
+        if pool is None:
+            return [load_image(r.content, image_format)]
+        return [await pool.run("generate", load_image, r.content, image_format)]
+    return []
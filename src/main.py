@@ -65,10 +65,56 @@ async def main():
             sdwui_sampler_name=config.get("sdwui_sampler_name"),
             sdwui_cfg_scale=config.get("sdwui_cfg_scale"),
             image_format=config.get("image_format"),
+            image_save_dir=config.get("image_save_dir"),
+            image_generation_concurrency=config.get("image_generation_concurrency"),
+            image_generation_max_batch=config.get("image_generation_max_batch"),
+            image_generation_max_queue=config.get("image_generation_max_queue"),
             gpt_vision_model=config.get("gpt_vision_model"),
             gpt_vision_api_endpoint=config.get("gpt_vision_api_endpoint"),
             timeout=config.get("timeout"),
             custom_help_message=custom_help_message,
+            conversation_cache_size=config.get("conversation_cache_size"),
+            conversation_cache_bytes=config.get("conversation_cache_bytes"),
+            db_flush_interval=config.get("db_flush_interval"),
+            db_synchronous=config.get("db_synchronous"),
+            stream_reply=config.get("stream_reply"),
+            stream_edit_interval=config.get("stream_edit_interval"),
+            stream_edit_min_chars=config.get("stream_edit_min_chars"),
+            max_concurrent_requests=config.get("max_concurrent_requests"),
+            max_queued_requests=config.get("max_queued_requests"),
+            max_queued_requests_per_room=config.get("max_queued_requests_per_room"),
+            response_cache_commands=config.get("response_cache_commands"),
+            response_cache_size=config.get("response_cache_size"),
+            response_cache_ttl=config.get("response_cache_ttl"),
+            response_cache_max_temperature=config.get(
+                "response_cache_max_temperature"
+            ),
+            tokenizer_cache_dir=config.get("tokenizer_cache_dir"),
+            metrics_host=config.get("metrics_host"),
+            metrics_port=config.get("metrics_port"),
+            http2=config.get("http2"),
+            http_pool_limits=config.get("http_pool_limits"),
+            http_prewarm=config.get("http_prewarm"),
+            gpt_api_endpoints=config.get("gpt_api_endpoints"),
+            endpoint_failure_threshold=config.get("endpoint_failure_threshold"),
+            endpoint_reset_timeout=config.get("endpoint_reset_timeout"),
+            endpoint_failover_timeout=config.get("endpoint_failover_timeout"),
+            hedge_percentile=config.get("hedge_percentile"),
+            hedge_budget=config.get("hedge_budget"),
+            openai_api_keys=config.get("openai_api_keys"),
+            rate_limit_max_wait=config.get("rate_limit_max_wait"),
+            rate_limit_release_interval=config.get("rate_limit_release_interval"),
+            event_cache_size=config.get("event_cache_size"),
+            media_cache_bytes=config.get("media_cache_bytes"),
+            media_cache_dir=config.get("media_cache_dir"),
+            media_cache_disk_bytes=config.get("media_cache_disk_bytes"),
+            vision_image_max_side=config.get("vision_image_max_side"),
+            vision_image_quality=config.get("vision_image_quality"),
+            vision_image_format=config.get("vision_image_format"),
+            image_workers=config.get("image_workers"),
+            image_pool=config.get("image_pool"),
+            image_queue_size=config.get("image_queue_size"),
+            vision_max_image_bytes=config.get("vision_max_image_bytes"),
         )
         if (
             config.get("import_keys_path")
@@ -104,10 +150,76 @@ async def main():
             sdwui_sampler_name=os.environ.get("SDWUI_SAMPLER_NAME"),
             sdwui_cfg_scale=float(os.environ.get("SDWUI_CFG_SCALE", 7)),
             image_format=os.environ.get("IMAGE_FORMAT"),
+            image_save_dir=os.environ.get("IMAGE_SAVE_DIR"),
+            image_generation_concurrency=int(
+                os.environ.get("IMAGE_GENERATION_CONCURRENCY", 1)
+            ),
+            image_generation_max_batch=int(
+                os.environ.get("IMAGE_GENERATION_MAX_BATCH", 4)
+            ),
+            image_generation_max_queue=int(
+                os.environ.get("IMAGE_GENERATION_MAX_QUEUE", 20)
+            ),
             gpt_vision_model=os.environ.get("GPT_VISION_MODEL"),
             gpt_vision_api_endpoint=os.environ.get("GPT_VISION_API_ENDPOINT"),
             timeout=float(os.environ.get("TIMEOUT", 120.0)),
             custom_help_message=custom_help_message,
+            conversation_cache_size=int(os.environ.get("CONVERSATION_CACHE_SIZE", 1000)),
+            conversation_cache_bytes=int(os.environ.get("CONVERSATION_CACHE_BYTES", 0)),
+            db_flush_interval=float(os.environ.get("DB_FLUSH_INTERVAL", 0.05)),
+            db_synchronous=os.environ.get("DB_SYNCHRONOUS"),
+            stream_reply=os.environ.get("STREAM_REPLY", "false").lower() == "true",
+            stream_edit_interval=float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5)),
+            stream_edit_min_chars=int(os.environ.get("STREAM_EDIT_MIN_CHARS", 80)),
+            max_concurrent_requests=int(os.environ.get("MAX_CONCURRENT_REQUESTS", 16)),
+            max_queued_requests=int(os.environ.get("MAX_QUEUED_REQUESTS", 100)),
+            max_queued_requests_per_room=int(
+                os.environ.get("MAX_QUEUED_REQUESTS_PER_ROOM", 20)
+            ),
+            response_cache_commands=os.environ.get("RESPONSE_CACHE_COMMANDS"),
+            response_cache_size=int(os.environ.get("RESPONSE_CACHE_SIZE", 256)),
+            response_cache_ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 300.0)),
+            response_cache_max_temperature=float(
+                os.environ.get("RESPONSE_CACHE_MAX_TEMPERATURE", 1.0)
+            ),
+            tokenizer_cache_dir=os.environ.get("TOKENIZER_CACHE_DIR"),
+            metrics_host=os.environ.get("METRICS_HOST"),
+            metrics_port=int(os.environ.get("METRICS_PORT", 0)),
+            http2=os.environ.get("HTTP2", "false").lower() == "true",
+            http_pool_limits=os.environ.get("HTTP_POOL_LIMITS"),
+            http_prewarm=os.environ.get("HTTP_PREWARM", "true").lower() == "true",
+            gpt_api_endpoints=os.environ.get("GPT_API_ENDPOINTS"),
+            endpoint_failure_threshold=int(
+                os.environ.get("ENDPOINT_FAILURE_THRESHOLD", 3)
+            ),
+            endpoint_reset_timeout=float(os.environ.get("ENDPOINT_RESET_TIMEOUT", 30.0)),
+            endpoint_failover_timeout=float(
+                os.environ.get("ENDPOINT_FAILOVER_TIMEOUT", 0)
+            ),
+            hedge_percentile=float(os.environ.get("HEDGE_PERCENTILE", 0)),
+            hedge_budget=float(os.environ.get("HEDGE_BUDGET", 0.05)),
+            openai_api_keys=os.environ.get("OPENAI_API_KEYS"),
+            rate_limit_max_wait=float(os.environ.get("RATE_LIMIT_MAX_WAIT", 60.0)),
+            rate_limit_release_interval=float(
+                os.environ.get("RATE_LIMIT_RELEASE_INTERVAL", 0.1)
+            ),
+            event_cache_size=int(os.environ.get("EVENT_CACHE_SIZE", 500)),
+            media_cache_bytes=int(
+                os.environ.get("MEDIA_CACHE_BYTES", 64 * 1024 * 1024)
+            ),
+            media_cache_dir=os.environ.get("MEDIA_CACHE_DIR"),
+            media_cache_disk_bytes=int(
+                os.environ.get("MEDIA_CACHE_DISK_BYTES", 512 * 1024 * 1024)
+            ),
+            vision_image_max_side=int(os.environ.get("VISION_IMAGE_MAX_SIDE", 0)),
+            vision_image_quality=int(os.environ.get("VISION_IMAGE_QUALITY", 85)),
+            vision_image_format=os.environ.get("VISION_IMAGE_FORMAT"),
+            image_workers=int(os.environ.get("IMAGE_WORKERS", 2)),
+            image_pool=os.environ.get("IMAGE_POOL"),
+            image_queue_size=int(os.environ.get("IMAGE_QUEUE_SIZE", 32)),
+            vision_max_image_bytes=int(
+                os.environ.get("VISION_MAX_IMAGE_BYTES", 20 * 1024 * 1024)
+            ),
         )
         if (
             os.environ.get("IMPORT_KEYS_PATH")
@@ -120,6 +232,9 @@ async def main():
         logger.info("start import_keys process, this may take a while...")
         await matrix_bot.import_keys()
 
+    await matrix_bot.start_metrics_server()
+    await matrix_bot.prewarm_connections()
+
     sync_task = asyncio.create_task(
         matrix_bot.sync_forever(timeout=30000, full_state=True)
     )
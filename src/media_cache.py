@@ -0,0 +1,217 @@
+"""
+Cache of downloaded Matrix media, keyed by mxc uri.
+An mxc uri always points to the same content, so entries never go stale
+"""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import os
+from typing import Awaitable, Callable, Optional
+
+from log import getlogger
+from vision_payload import encode_data_url
+
+logger = getlogger()
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path: str, body: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(body)
+
+
+def _remove_files(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class MediaEntry:
+    """
+    Bytes of a media and its data url, encoded on first use
+    """
+
+    def __init__(self, mxc: str, body: bytes, mimetype: str) -> None:
+        self.mxc = mxc
+        self.body = body
+        self.mimetype = mimetype
+        self.data_url: Optional[bytearray] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + (len(self.data_url) if self.data_url else 0)
+
+
+class MediaCache:
+    """
+    max_bytes: memory budget of bytes and data urls, 0 disables the cache
+    spill_dir: directory to keep media evicted from memory, None to drop them
+    max_disk_bytes: budget of spill_dir
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        spill_dir: Optional[str] = None,
+        max_disk_bytes: int = 512 * 1024 * 1024,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self._entries: OrderedDict[str, MediaEntry] = OrderedDict()
+        self._bytes = 0
+        # mxc -> size and mimetype of the spilled file
+        self._disk: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        self._disk_bytes = 0
+        # mxc -> body and mimetype of media being written to disk
+        self._spilling: dict[str, tuple[bytes, str]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _path(self, mxc: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha256(mxc.encode()).hexdigest())
+
+    def _add(self, mxc: str, entry: MediaEntry) -> None:
+        self._entries[mxc] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def _evict(self) -> None:
+        # keep the newest entry even if it is over budget on its own
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            mxc, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            if self.spill_dir is not None:
+                self._spill(mxc, entry.body, entry.mimetype)
+
+    def _spill(self, mxc: str, body: bytes, mimetype: str) -> None:
+        if (
+            mxc in self._disk
+            or mxc in self._spilling
+            or len(body) > self.max_disk_bytes
+        ):
+            return
+        # written in a worker thread, served from memory until it is done
+        self._spilling[mxc] = (body, mimetype)
+        task = asyncio.create_task(self._write(mxc, body, mimetype))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, mxc: str, body: bytes, mimetype: str) -> None:
+        try:
+            await asyncio.to_thread(_write_file, self._path(mxc), body)
+        except OSError as e:
+            logger.warning(f"Failed to spill {mxc} to disk: {e}")
+            return
+        finally:
+            del self._spilling[mxc]
+        self._disk[mxc] = (len(body), mimetype)
+        self._disk_bytes += len(body)
+        removed = []
+        while self._disk_bytes > self.max_disk_bytes:
+            old, (size, _) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            removed.append(self._path(old))
+        if removed:
+            await asyncio.to_thread(_remove_files, removed)
+
+    async def _load(self, mxc: str) -> Optional[tuple[bytes, str]]:
+        if mxc in self._spilling:
+            return self._spilling[mxc]
+        if mxc not in self._disk:
+            return None
+        _, mimetype = self._disk[mxc]
+        try:
+            body = await asyncio.to_thread(_read_file, self._path(mxc))
+        except OSError:
+            if mxc in self._disk:
+                self._disk_bytes -= self._disk.pop(mxc)[0]
+            return None
+        if mxc in self._disk:
+            self._disk.move_to_end(mxc)
+        return body, mimetype
+
+    async def get_or_fetch(
+        self, mxc: str, fetch: Callable[[], Awaitable[Optional[tuple[bytes, str]]]]
+    ) -> Optional[MediaEntry]:
+        """
+        Return the cached media, from memory or from disk, or wait for the
+        same download in flight, or call fetch for the bytes and mimetype.
+        None if fetch returned None
+        """
+        entry = self._entries.get(mxc)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(mxc)
+            return entry
+
+        future = self._inflight.get(mxc)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[mxc] = future
+        try:
+            media = None
+            if self.spill_dir is not None:
+                media = await self._load(mxc)
+            if media is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                media = await fetch()
+            entry = MediaEntry(mxc, *media) if media is not None else None
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # don't warn about an exception nobody waited for
+            future.exception()
+            raise
+        else:
+            future.set_result(entry)
+            if entry is not None:
+                self._add(mxc, entry)
+            return entry
+        finally:
+            del self._inflight[mxc]
+
+    def data_url(self, entry: MediaEntry) -> bytearray:
+        """
+        data: url of an entry, encoded once and kept with its bytes
+        """
+        if entry.data_url is None:
+            old_size = entry.size
+            entry.data_url = encode_data_url(entry.body, entry.mimetype)
+            if self._entries.get(entry.mxc) is entry:
+                self._bytes += entry.size - old_size
+                self._evict()
+        return entry.data_url
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+        }
@@ -0,0 +1,514 @@
+"""
+Prometheus metrics, rendered in the text exposition format by MetricsServer
+"""
+import asyncio
+from collections import OrderedDict
+import functools
+import math
+import threading
+import time
+from typing import Callable, Optional
+
+import httpx
+
+from log import getlogger
+
+logger = getlogger()
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+IMAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # updated from the db writer thread too
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ] + self._samples()
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Read the value from function at scrape time, only for unlabelled gauges
+        """
+        self._function = function
+
+    def _samples(self) -> list[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [bucket counts, sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]  # noqa: E501
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"  # noqa: E501
+                )
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """
+        Call collector before every render, to update metrics from other objects
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"metrics collector failed: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_command_seconds",
+        "Time spent handling a command",
+        ("command",),
+    )
+)
+COMMAND_INFLIGHT = REGISTRY.register(
+    Gauge(
+        "matrix_bot_command_inflight",
+        "Commands being handled",
+        ("command",),
+    )
+)
+REQUESTS_INFLIGHT = REGISTRY.register(
+    Gauge(
+        "matrix_bot_requests_inflight",
+        "Requests running in the request scheduler",
+    )
+)
+REQUESTS_QUEUED = REGISTRY.register(
+    Gauge(
+        "matrix_bot_requests_queued",
+        "Requests waiting in the request scheduler",
+    )
+)
+UPSTREAM_TTFB_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_upstream_ttfb_seconds",
+        "Time from sending an upstream request to its response headers",
+        ("upstream",),
+    )
+)
+UPSTREAM_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_upstream_seconds",
+        "Time from sending an upstream request to the end of its response body",
+        ("upstream", "status"),
+    )
+)
+TOKENS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_tokens",
+        "Prompt and completion tokens per chat completion, "
+        "from the usage field when the upstream returns one, otherwise counted locally",
+        ("kind", "model"),
+        buckets=TOKEN_BUCKETS,
+    )
+)
+DB_WRITE_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_db_write_seconds",
+        "Time to write and commit a batch to context.db",
+        buckets=DB_BUCKETS,
+    )
+)
+HTTP_POOL_CONNECTIONS = REGISTRY.register(
+    Gauge(
+        "matrix_bot_http_pool_connections",
+        "Open connections of an upstream pool",
+        ("pool", "state"),
+    )
+)
+HTTP_POOL_QUEUED = REGISTRY.register(
+    Gauge(
+        "matrix_bot_http_pool_queued_requests",
+        "Requests waiting for a connection of an upstream pool",
+        ("pool",),
+    )
+)
+HTTP_POOL_MAX_CONNECTIONS = REGISTRY.register(
+    Gauge(
+        "matrix_bot_http_pool_max_connections",
+        "Connection limit of an upstream pool",
+        ("pool",),
+    )
+)
+ENDPOINT_AVAILABLE = REGISTRY.register(
+    Gauge(
+        "matrix_bot_endpoint_available",
+        "1 if the circuit of a chat completions endpoint is closed",
+        ("endpoint",),
+    )
+)
+ENDPOINT_LATENCY_SECONDS = REGISTRY.register(
+    Gauge(
+        "matrix_bot_endpoint_latency_seconds",
+        "Moving average of the time to response headers of an endpoint",
+        ("endpoint",),
+    )
+)
+HEDGED_REQUESTS = REGISTRY.register(
+    Counter(
+        "matrix_bot_hedged_requests_total",
+        "Slow one-shot requests, by the request that won or no_budget",
+        ("outcome",),
+    )
+)
+RATE_LIMITED = REGISTRY.register(
+    Counter(
+        "matrix_bot_rate_limited_total",
+        "429 responses of a chat completions endpoint",
+        ("endpoint",),
+    )
+)
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_rate_limit_wait_seconds",
+        "Time a request was held back to stay within the rate limit",
+        ("endpoint",),
+    )
+)
+EVENT_CACHE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "matrix_bot_event_cache_lookups_total",
+        "Lookups of replied to events in the event cache, by hit or miss",
+        ("result",),
+    )
+)
+IMAGE_WORK_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_image_work_seconds",
+        "Time a worker of the image pool spent on a job, by operation",
+        ("op",),
+        buckets=IMAGE_BUCKETS,
+    )
+)
+IMAGE_QUEUE_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_image_queue_wait_seconds",
+        "Time a job waited for a worker of the image pool, by operation",
+        ("op",),
+        buckets=IMAGE_BUCKETS,
+    )
+)
+IMAGE_JOBS_PENDING = REGISTRY.register(
+    Gauge(
+        "matrix_bot_image_jobs_pending",
+        "Jobs running or waiting in the image pool",
+    )
+)
+IMAGE_JOBS_INFLIGHT = REGISTRY.register(
+    Gauge(
+        "matrix_bot_image_jobs_inflight",
+        "Calls to the image generation backend running",
+    )
+)
+IMAGE_JOBS_QUEUED = REGISTRY.register(
+    Gauge(
+        "matrix_bot_image_jobs_queued",
+        "Image generation jobs waiting for a call to the backend",
+    )
+)
+IMAGE_JOB_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_image_job_wait_seconds",
+        "Time an image generation job waited for a call to the backend",
+    )
+)
+IMAGE_BATCH_SIZE = REGISTRY.register(
+    Histogram(
+        "matrix_bot_image_batch_size",
+        "Image generation jobs coalesced into one call to the backend",
+        buckets=(1, 2, 3, 4, 6, 8, 16),
+    )
+)
+REPLY_LAG_SECONDS = REGISTRY.register(
+    Histogram(
+        "matrix_bot_reply_lag_seconds",
+        "Time from the origin_server_ts of a message to the first reply being sent",
+    )
+)
+
+
+def timed_command(command: str) -> Callable:
+    """
+    Decorator of Bot command handlers, record their duration and in flight count
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            COMMAND_INFLIGHT.inc(command=command)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                COMMAND_INFLIGHT.dec(command=command)
+                COMMAND_SECONDS.observe(time.perf_counter() - start, command=command)
+
+        return wrapper
+
+    return decorator
+
+
+# event_id -> origin_server_ts in milliseconds, of messages waiting for a reply
+_event_timestamps: OrderedDict[str, int] = OrderedDict()
+MAX_TRACKED_EVENTS = 1000
+
+
+def track_event(event_id: str, origin_server_ts: int) -> None:
+    _event_timestamps[event_id] = origin_server_ts
+    while len(_event_timestamps) > MAX_TRACKED_EVENTS:
+        _event_timestamps.popitem(last=False)
+
+
+def observe_reply(reply_to_event_id: str) -> None:
+    """
+    Record the lag of the first reply to a tracked message
+    """
+    origin_server_ts = _event_timestamps.pop(reply_to_event_id, None)
+    if origin_server_ts is not None:
+        REPLY_LAG_SECONDS.observe(max(time.time() - origin_server_ts / 1000, 0))
+
+
+class _TimedStream(httpx.AsyncByteStream):
+    def __init__(
+        self, stream: httpx.AsyncByteStream, start: float, upstream: str, status: int
+    ) -> None:
+        self._stream = stream
+        self._start = start
+        self._upstream = upstream
+        self._status = status
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+        UPSTREAM_SECONDS.observe(
+            time.perf_counter() - self._start,
+            upstream=self._upstream,
+            status=self._status,
+        )
+
+
+class MetricsTransport(httpx.AsyncBaseTransport):
+    """
+    Wrap a transport to record the TTFB and total time of requests by host:port
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        upstream = request.url.netloc.decode("ascii")
+        response = await self._transport.handle_async_request(request)
+        UPSTREAM_TTFB_SECONDS.observe(time.perf_counter() - start, upstream=upstream)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_TimedStream(response.stream, start, upstream, response.status_code),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class MetricsServer:
+    """
+    Serve GET /metrics over plain HTTP
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9090) -> None:
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # skip the request headers
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (
+                b"\r\n",
+                b"\n",
+                b"",
+            ):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":  # noqa: E501
+                status = "200 OK"
+                body = REGISTRY.render().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+                content_type = "text/plain; charset=utf-8"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"metrics request failed: {e}")
+        finally:
+            writer.close()
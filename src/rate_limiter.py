@@ -0,0 +1,188 @@
+"""
+Client side rate limiting of chat completions, learned from the
+x-ratelimit-* and retry-after headers of the upstream
+"""
+import asyncio
+from email.utils import parsedate_to_datetime
+import re
+import time
+from typing import Optional
+
+import httpx
+
+from log import getlogger
+from metrics import RATE_LIMIT_WAIT_SECONDS, RATE_LIMITED
+
+logger = getlogger()
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RateLimitExceeded(Exception):
+    """
+    The rate limit of every key resets later than the wait we accept
+    """
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parse the reset durations of OpenAI, like 20ms, 1s or 6m0s
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_retry_after(headers: httpx.Headers) -> Optional[float]:
+    """
+    Seconds to wait from retry-after-ms or retry-after, in seconds or a http date
+    """
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimit:
+    """
+    Budget of one api key on one endpoint.
+    The remaining requests and tokens come from the last response headers,
+    requests sent since then are taken from the remaining requests locally
+    until the next response corrects them
+    """
+
+    def __init__(self) -> None:
+        self.remaining_requests: Optional[int] = None
+        self.reset_requests_at = 0.0
+        self.remaining_tokens: Optional[int] = None
+        self.reset_tokens_at = 0.0
+        # set by a 429
+        self.blocked_until = 0.0
+        # when the next waiter is released, waiters are let through
+        # one at a time when the window reopens, not all together
+        self.next_release = 0.0
+
+    def ready_at(self) -> float:
+        """
+        Monotonic time from which a request can be sent
+        """
+        ready = self.blocked_until
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            ready = max(ready, self.reset_requests_at)
+        if self.remaining_tokens is not None and self.remaining_tokens <= 0:
+            ready = max(ready, self.reset_tokens_at)
+        return ready
+
+    def take(self, now: float) -> None:
+        if self.remaining_requests is None:
+            return
+        if now >= self.reset_requests_at:
+            # the window reset, the next response tells the new budget
+            self.remaining_requests = None
+        else:
+            self.remaining_requests -= 1
+
+    def update(self, response: httpx.Response, now: float) -> None:
+        headers = response.headers
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = parse_duration(headers.get("x-ratelimit-reset-requests", ""))
+        if remaining is not None and remaining.isdigit() and reset is not None:
+            self.remaining_requests = int(remaining)
+            self.reset_requests_at = now + reset
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        reset = parse_duration(headers.get("x-ratelimit-reset-tokens", ""))
+        if remaining is not None and remaining.isdigit() and reset is not None:
+            self.remaining_tokens = int(remaining)
+            self.reset_tokens_at = now + reset
+        if response.status_code == 429:
+            retry_after = parse_retry_after(headers)
+            # without a hint, back off for a second
+            self.blocked_until = now + (retry_after if retry_after is not None else 1.0)
+
+
+class RateLimiter:
+    """
+    One RateLimit per endpoint and api key.
+    max_wait: longest pause in seconds before giving up on a key
+    release_interval: seconds between two waiters released when a limit resets
+    """
+
+    def __init__(self, max_wait: float = 60.0, release_interval: float = 0.1) -> None:
+        self.max_wait = max_wait
+        self.release_interval = release_interval
+        self.limits: dict[tuple[str, str], RateLimit] = {}
+
+        self.waited = 0.0
+        self.rate_limited = 0
+
+    def _get(self, endpoint: str, key: str) -> RateLimit:
+        limit = self.limits.get((endpoint, key))
+        if limit is None:
+            limit = self.limits[(endpoint, key)] = RateLimit()
+        return limit
+
+    def pick_key(self, endpoint: str, keys: list[str]) -> str:
+        """
+        The key of the pool that can send first, with the most requests left
+        """
+        if len(keys) == 1:
+            return keys[0]
+        return min(
+            keys,
+            key=lambda key: (
+                self._get(endpoint, key).ready_at(),
+                -(self._get(endpoint, key).remaining_requests or 0),
+            ),
+        )
+
+    async def acquire(self, endpoint: str, key: str) -> None:
+        """
+        Wait until the budget of the key allows a request, then take one
+        """
+        limit = self._get(endpoint, key)
+        now = time.monotonic()
+        # behind the waiters already queued for the reset
+        release = max(limit.ready_at(), limit.next_release)
+        wait = release - now
+        if wait > self.max_wait:
+            raise RateLimitExceeded(
+                f"rate limit of {endpoint} resets in {wait:.0f}s"
+            )
+        if wait > 0:
+            limit.next_release = release + self.release_interval
+            logger.info(f"Rate limit of {endpoint} reached, waiting {wait:.2f}s")
+            RATE_LIMIT_WAIT_SECONDS.observe(wait, endpoint=endpoint)
+            self.waited += wait
+            await asyncio.sleep(wait)
+            now = time.monotonic()
+        limit.take(now)
+
+    def update(self, endpoint: str, key: str, response: httpx.Response) -> None:
+        if response.status_code == 429:
+            self.rate_limited += 1
+            RATE_LIMITED.inc(endpoint=endpoint)
+        self._get(endpoint, key).update(response, time.monotonic())
+
+    def stats(self) -> dict:
+        return {
+            "rate_limited": self.rate_limited,
+            "waited": round(self.waited, 3),
+        }
@@ -0,0 +1,108 @@
+"""
+LRU + TTL cache for one shot responses with in-flight request coalescing
+"""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split())
+
+
+def make_key(**params: Any) -> str:
+    """
+    Build a cache key from the request parameters
+    """
+    if "prompt" in params:
+        params["prompt"] = normalize_prompt(params["prompt"])
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    max_entries: max number of cached responses
+    ttl: seconds a response stays valid
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # key -> (expire time, response)
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expire, response = entry
+        if expire < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key: str, response: str) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(
+        self, key: str, fetch: Callable[[], Awaitable[str]]
+    ) -> tuple[str, bool]:
+        """
+        Return the cached response, or wait for an identical request in flight,
+        or call fetch. The second value is True if fetch was called by this caller.
+        """
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            return response, False
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), False
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # don't warn about an exception nobody waited for
+            future.exception()
+            raise
+        else:
+            future.set_result(response)
+            self.put(key, response)
+            return response, True
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        requests = self.hits + self.coalesced + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.coalesced) / requests, 3)
+            if requests
+            else 0.0,
+        }
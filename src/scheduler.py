@@ -0,0 +1,202 @@
+"""
+Bounded request scheduler with per room and per sender fair queuing
+"""
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import time
+from typing import AsyncIterator, Coroutine, Optional
+
+from log import getlogger
+
+logger = getlogger()
+
+
+class RequestScheduler:
+    """
+    max_inflight: max number of requests running at the same time
+    max_queue: max number of requests waiting for a slot
+    max_queue_per_room: max number of waiting requests of a single room, 0 for unlimited
+
+    Waiting requests are picked round robin over rooms,
+    then round robin over senders inside the room.
+    Requests of the same lane, a conversation, run one at a time in
+    arrival order, and a request waiting for its lane doesn't take a slot.
+    """
+
+    def __init__(
+        self,
+        max_inflight: int = 16,
+        max_queue: int = 100,
+        max_queue_per_room: int = 20,
+    ) -> None:
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_queue_per_room = max_queue_per_room
+
+        # room_id -> sender_id -> (enqueue time, coroutine, lane, sequence)
+        self._rooms: OrderedDict[str, OrderedDict[str, deque]] = OrderedDict()
+        self._room_depth: dict[str, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # lanes with a running request, and sequences of the waiting ones
+        self._busy_lanes: set[str] = set()
+        self._lane_queues: dict[str, deque] = {}
+        self._sequence = 0
+
+        self.inflight = 0
+        self.queued = 0
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def submit(
+        self,
+        room_id: str,
+        sender_id: str,
+        coro: Coroutine,
+        lane: Optional[str] = None,
+    ) -> bool:
+        """
+        Run coro now or queue it, return False if the queue is full.
+        lane: requests of the same lane never run at the same time
+        """
+        if (
+            self.inflight < self.max_inflight
+            and self.queued == 0
+            and lane not in self._busy_lanes
+        ):
+            self.submitted += 1
+            self._start(coro, 0.0, lane)
+            return True
+
+        room_depth = self._room_depth.get(room_id, 0)
+        if self.queued >= self.max_queue or (
+            self.max_queue_per_room and room_depth >= self.max_queue_per_room
+        ):
+            self.rejected += 1
+            coro.close()
+            logger.warning(f"Request queue full, rejected request in {room_id}")
+            return False
+
+        self.submitted += 1
+        self._sequence += 1
+        if lane is not None:
+            self._lane_queues.setdefault(lane, deque()).append(self._sequence)
+        senders = self._rooms.setdefault(room_id, OrderedDict())
+        senders.setdefault(sender_id, deque()).append(
+            (time.monotonic(), coro, lane, self._sequence)
+        )
+        self._room_depth[room_id] = room_depth + 1
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        self._dispatch()
+        return True
+
+    def _start(self, coro: Coroutine, waited: float, lane: Optional[str]) -> None:
+        self.inflight += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        if lane is not None:
+            self._busy_lanes.add(lane)
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(lambda task: self._done(task, lane))
+
+    def _done(self, task: asyncio.Task, lane: Optional[str]) -> None:
+        self._tasks.discard(task)
+        self.inflight -= 1
+        self.completed += 1
+        self._busy_lanes.discard(lane)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(task.exception())
+        self._dispatch()
+
+    def _ready(self, lane: Optional[str], sequence: int) -> bool:
+        # the lane is idle and this is its oldest waiting request
+        return lane is None or (
+            lane not in self._busy_lanes and self._lane_queues[lane][0] == sequence
+        )
+
+    def _pick(self) -> Optional[tuple]:
+        for room_id, senders in self._rooms.items():
+            for sender_id, jobs in senders.items():
+                for job in jobs:
+                    if self._ready(job[2], job[3]):
+                        jobs.remove(job)
+                        # move the sender and room to the back of the line
+                        del senders[sender_id]
+                        if jobs:
+                            senders[sender_id] = jobs
+                        del self._rooms[room_id]
+                        if senders:
+                            self._rooms[room_id] = senders
+                        return room_id, job
+        return None
+
+    def _dispatch(self) -> None:
+        while self.inflight < self.max_inflight and self._rooms:
+            picked = self._pick()
+            if picked is None:
+                # everything waiting is behind a running request of its lane
+                break
+            room_id, (enqueued_at, coro, lane, sequence) = picked
+            if lane is not None:
+                lane_queue = self._lane_queues[lane]
+                lane_queue.popleft()
+                if not lane_queue:
+                    del self._lane_queues[lane]
+            self._room_depth[room_id] -= 1
+            if self._room_depth[room_id] == 0:
+                del self._room_depth[room_id]
+            self.queued -= 1
+            self._start(coro, time.monotonic() - enqueued_at, lane)
+
+    def stats(self) -> dict:
+        started = self.submitted - self.queued
+        return {
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "wait_seconds_avg": round(self.wait_seconds_total / started, 3)
+            if started
+            else 0.0,
+        }
+
+
+class ConversationLanes:
+    """
+    Run turns of one conversation in order, one at a time,
+    while different conversations still run in parallel.
+    Waiters of a lane are served in arrival order and a lane is dropped
+    as soon as nobody is using or waiting for it.
+    """
+
+    def __init__(self) -> None:
+        # convo_id -> [lock, number of users]
+        self._lanes: dict[str, list] = {}
+
+    @asynccontextmanager
+    async def lane(self, convo_id: str) -> AsyncIterator[None]:
+        entry = self._lanes.get(convo_id)
+        if entry is None:
+            entry = self._lanes[convo_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._lanes[convo_id]
+
+    def __len__(self) -> int:
+        return len(self._lanes)
@@ -2,14 +2,13 @@
 code derived from:
 https://matrix-nio.readthedocs.io/en/latest/examples.html#sending-an-image
 """
-import os
+import io
 
-import aiofiles.os
-import magic
+from imagegen import GeneratedImage
 from log import getlogger
+from metrics import observe_reply
 from nio import AsyncClient
 from nio import UploadResponse
-from PIL import Image
 
 logger = getlogger()
 
@@ -17,28 +16,21 @@ logger = getlogger()
 async def send_room_image(
     client: AsyncClient,
     room_id: str,
-    image: str,
+    image: GeneratedImage,
     reply_to_event_id=None,
     reply_in_thread=False,
     thread_root_id=None,
 ):
     """
-    image: image path
+    image: encoded image in memory, uploaded as is
     """
-    mime_type = magic.from_file(image, mime=True)  # e.g. "image/jpeg"
-
-    im = Image.open(image)
-    (width, height) = im.size  # im.size returns (width,height) tuple
-
     # first do an upload of image, then send URI of upload to room
-    file_stat = await aiofiles.os.stat(image)
-    async with aiofiles.open(image, "r+b") as f:
-        resp, maybe_keys = await client.upload(
-            f,
-            content_type=mime_type,  # image/jpeg
-            filename=os.path.basename(image),
-            filesize=file_stat.st_size,
-        )
+    resp, maybe_keys = await client.upload(
+        io.BytesIO(image.body),
+        content_type=image.mimetype,  # image/jpeg
+        filename=image.filename,
+        filesize=image.size,
+    )
     if not isinstance(resp, UploadResponse):
         logger.warning(f"Failed to upload image. Failure response: {resp}")
         await client.room_send(
@@ -53,12 +45,12 @@ async def send_room_image(
         return
 
     content = {
-        "body": os.path.basename(image),  # descriptive title
+        "body": image.filename,  # descriptive title
         "info": {
-            "size": file_stat.st_size,
-            "mimetype": mime_type,
-            "w": width,  # width in pixel
-            "h": height,  # height in pixel
+            "size": image.size,
+            "mimetype": image.mimetype,
+            "w": image.width,  # width in pixel
+            "h": image.height,  # height in pixel
         },
         "msgtype": "m.image",
         "url": resp.content_uri,
@@ -66,12 +58,12 @@ async def send_room_image(
 
     if reply_in_thread:
         content = {
-            "body": os.path.basename(image),  # descriptive title
+            "body": image.filename,  # descriptive title
             "info": {
-                "size": file_stat.st_size,
-                "mimetype": mime_type,
-                "w": width,  # width in pixel
-                "h": height,  # height in pixel
+                "size": image.size,
+                "mimetype": image.mimetype,
+                "w": image.width,  # width in pixel
+                "h": image.height,  # height in pixel
             },
             "msgtype": "m.image",
             "url": resp.content_uri,
@@ -85,6 +77,10 @@ async def send_room_image(
 
     try:
         await client.room_send(room_id, message_type="m.room.message", content=content)
+        if reply_to_event_id:
+            observe_reply(reply_to_event_id)
     except Exception as e:
-        logger.error(f"Image send of file {image} failed.\n Error: {e}", exc_info=True)
+        logger.error(
+            f"Image send of file {image.filename} failed.\n Error: {e}", exc_info=True
+        )
         raise Exception(e)
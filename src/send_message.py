@@ -1,6 +1,10 @@
+import time
+from typing import AsyncGenerator
+
 import markdown
 from log import getlogger
-from nio import AsyncClient
+from metrics import observe_reply
+from nio import AsyncClient, RoomSendResponse
 
 logger = getlogger()
 
@@ -14,7 +18,7 @@ async def send_room_message(
     reply_to_event_id: str = "",
     reply_in_thread: bool = False,
     thread_root_id: str = "",
-) -> None:
+):
     if reply_to_event_id == "":
         content = {
             "msgtype": "m.text",
@@ -71,10 +75,120 @@ async def send_room_message(
             "m.relates_to": {"m.in_reply_to": {"event_id": reply_to_event_id}},
         }
 
-    await client.room_send(
+    resp = await client.room_send(
         room_id,
         message_type="m.room.message",
         content=content,
         ignore_unverified_devices=True,
     )
+    if reply_to_event_id:
+        observe_reply(reply_to_event_id)
     await client.room_typing(room_id, typing_state=False)
+    return resp
+
+
+async def edit_room_message(
+    client: AsyncClient,
+    room_id: str,
+    event_id: str,
+    reply_message: str,
+):
+    """
+    Replace the content of a message sent by the bot
+    """
+    formatted_body = markdown.markdown(
+        reply_message,
+        extensions=["nl2br", "tables", "fenced_code"],
+    )
+    content = {
+        "msgtype": "m.text",
+        "body": "* " + reply_message,
+        "format": "org.matrix.custom.html",
+        "formatted_body": "* " + formatted_body,
+        "m.new_content": {
+            "msgtype": "m.text",
+            "body": reply_message,
+            "format": "org.matrix.custom.html",
+            "formatted_body": formatted_body,
+        },
+        "m.relates_to": {"rel_type": "m.replace", "event_id": event_id},
+    }
+    return await client.room_send(
+        room_id,
+        message_type="m.room.message",
+        content=content,
+        ignore_unverified_devices=True,
+    )
+
+
+async def send_room_message_stream(
+    client: AsyncClient,
+    room_id: str,
+    reply_stream: AsyncGenerator[str, None],
+    sender_id: str = "",
+    user_message: str = "",
+    reply_to_event_id: str = "",
+    reply_in_thread: bool = False,
+    thread_root_id: str = "",
+    edit_interval: float = 1.5,
+    edit_min_chars: int = 80,
+) -> str:
+    """
+    Send the first chunk of reply_stream as soon as it arrives,
+    then update the message with m.replace edits.
+    Edits are sent at most every edit_interval seconds and only when
+    at least edit_min_chars new characters arrived, the final text is always sent,
+    an empty reply as a plain message.
+    Return the full reply.
+    """
+    full_response = ""
+    sent_message = ""
+    event_id = None
+    last_edit = 0.0
+    async for chunk in reply_stream:
+        full_response += chunk
+        reply_message = full_response.strip()
+        if not reply_message:
+            continue
+        if event_id is None:
+            resp = await send_room_message(
+                client,
+                room_id,
+                reply_message=reply_message,
+                sender_id=sender_id,
+                user_message=user_message,
+                reply_to_event_id=reply_to_event_id,
+                reply_in_thread=reply_in_thread,
+                thread_root_id=thread_root_id,
+            )
+            if not isinstance(resp, RoomSendResponse):
+                raise Exception(f"Failed to send message: {resp}")
+            event_id = resp.event_id
+        elif (
+            time.monotonic() - last_edit >= edit_interval
+            and len(reply_message) - len(sent_message) >= edit_min_chars
+        ):
+            await edit_room_message(client, room_id, event_id, reply_message)
+        else:
+            continue
+        sent_message = reply_message
+        last_edit = time.monotonic()
+
+    reply_message = full_response.strip()
+    if event_id is None:
+        # empty completion, reply like the non-streaming path does
+        resp = await send_room_message(
+            client,
+            room_id,
+            reply_message=reply_message,
+            sender_id=sender_id,
+            user_message=user_message,
+            reply_to_event_id=reply_to_event_id,
+            reply_in_thread=reply_in_thread,
+            thread_root_id=thread_root_id,
+        )
+        if not isinstance(resp, RoomSendResponse):
+            raise Exception(f"Failed to send message: {resp}")
+    elif reply_message != sent_message:
+        await edit_room_message(client, room_id, event_id, reply_message)
+    return full_response
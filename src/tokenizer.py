@@ -0,0 +1,57 @@
+"""
+Load tiktoken encodings once at startup and encode large texts off the event loop
+
+To prepare an offline cache directory, run on a machine with internet access:
+python src/tokenizer.py tiktoken_cache
+"""
+import asyncio
+import os
+import sys
+import time
+from typing import Optional
+
+import tiktoken
+
+from log import getlogger
+
+logger = getlogger()
+
+
+def load_encoding(model: str, cache_dir: Optional[str] = None) -> tiktoken.Encoding:
+    """
+    Resolve and load the encoding of model, BPE files are read from cache_dir
+    """
+    if cache_dir:
+        # tiktoken looks up its BPE files here before downloading them
+        os.environ["TIKTOKEN_CACHE_DIR"] = str(cache_dir)
+    tiktoken.model.MODEL_TO_ENCODING["gpt-4"] = "cl100k_base"
+
+    start = time.perf_counter()
+    encoding = tiktoken.encoding_for_model(model)
+    # warm up the encoder
+    encoding.encode("warm up")
+    logger.info(
+        f"Tokenizer {encoding.name} for {model} loaded in "
+        f"{(time.perf_counter() - start) * 1000:.1f} ms"
+    )
+    return encoding
+
+
+async def count_tokens_async(
+    encoding: tiktoken.Encoding, text: str, offload_chars: int = 4096
+) -> int:
+    """
+    Count tokens of text, texts longer than offload_chars are encoded in a thread
+    """
+    if len(text) <= offload_chars:
+        return len(encoding.encode(text))
+    return len(await asyncio.to_thread(encoding.encode, text))
+
+
+if __name__ == "__main__":
+    # download BPE files of the supported models into the given directory
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else "tiktoken_cache"
+    os.makedirs(cache_dir, exist_ok=True)
+    for model in ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo"]:
+        load_encoding(model, cache_dir)
+    print(f"tiktoken cache saved to {cache_dir}")
@@ -0,0 +1,90 @@
+"""
+Build vision requests without copying the image around: the image is
+base64 encoded once into a preallocated buffer, and the JSON body is
+streamed from slices of that buffer instead of json.dumps of the payload
+"""
+import binascii
+import json
+import re
+from typing import AsyncIterator, Union
+import uuid
+
+# raw bytes encoded per step, a multiple of 3 so chunks concatenate
+ENCODE_CHUNK = 3 * 64 * 1024
+# bytes of request body sent per write
+SEND_CHUNK = 64 * 1024
+
+MIMETYPE = re.compile(r"^[\w.+-]+/[\w.+-]+$")
+
+
+def encode_data_url(body: bytes, mimetype: str) -> bytearray:
+    """
+    data: url of body, base64 encoded straight into a buffer of its final size
+    """
+    if not MIMETYPE.match(mimetype):
+        mimetype = "application/octet-stream"
+    prefix = f"data:{mimetype};base64,".encode()
+    buffer = bytearray(len(prefix) + 4 * ((len(body) + 2) // 3))
+    buffer[: len(prefix)] = prefix
+    view = memoryview(buffer)
+    source = memoryview(body)
+    pos = len(prefix)
+    for start in range(0, len(body), ENCODE_CHUNK):
+        encoded = binascii.b2a_base64(
+            source[start : start + ENCODE_CHUNK], newline=False
+        )
+        view[pos : pos + len(encoded)] = encoded
+        pos += len(encoded)
+    return buffer
+
+
+class VisionPayload:
+    """
+    Streamed JSON body of a chat completions request with one image.
+    image_url: an http(s) url, or a data url from encode_data_url
+    extra: other fields of the request, like stream
+    """
+
+    def __init__(
+        self,
+        model: str,
+        prompt: str,
+        image_url: Union[str, bytes, bytearray],
+        **extra,
+    ) -> None:
+        if isinstance(image_url, str):
+            image_url = json.dumps(image_url)[1:-1].encode()
+        # json.dumps the payload around a placeholder, then cut it out
+        placeholder = uuid.uuid4().hex
+        payload = {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": placeholder}},
+                    ],
+                }
+            ],
+            **extra,
+        }
+        head, tail = json.dumps(payload).encode().split(placeholder.encode())
+        self.head = head
+        self.tail = tail
+        # a data url is plain ASCII without quotes or backslashes
+        self.image_url = memoryview(image_url)
+
+    def __len__(self) -> int:
+        return len(self.head) + len(self.image_url) + len(self.tail)
+
+    @property
+    def headers(self) -> dict:
+        return {"Content-Type": "application/json", "Content-Length": str(len(self))}
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        # a new iteration every time, so the request can be sent again
+        yield self.head
+        for start in range(0, len(self.image_url), SEND_CHUNK):
+            yield bytes(self.image_url[start : start + SEND_CHUNK])
+        yield self.tail